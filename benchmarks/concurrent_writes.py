@@ -0,0 +1,87 @@
+"""SQLite并发写入基准测试
+
+模拟多个gunicorn worker进程同时创建条目, 对比默认设置与Production中的PRAGMA(WAL, synchronous=NORMAL,
+busy_timeout, mmap_size, cache_size)的吞吐量和"database is locked"错误数.
+
+运行: python benchmarks/concurrent_writes.py [--workers 8] [--writes 200]
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from todoism.extensions import sqlite_pragmas  # noqa
+from todoism.setting import Production  # noqa
+
+SCHEMA = ('CREATE TABLE item (id INTEGER PRIMARY KEY, body TEXT, done BOOLEAN, timestamp DATETIME, '
+          'author_id INTEGER)')
+
+
+def make_engine(path, pragmas, timeout):
+    engine = create_engine('sqlite:///' + path, connect_args=dict(timeout=timeout))
+    if pragmas:
+        event.listen(engine, 'connect', sqlite_pragmas(pragmas))
+    return engine
+
+
+def worker(path, pragmas, timeout, writes, queue):
+    engine = make_engine(path, pragmas, timeout)
+    errors = 0
+    for i in range(writes):
+        try:
+            with engine.begin() as conn:
+                # 与请求中的写操作一样: 先读后写, 再提交
+                conn.execute('SELECT count(*) FROM item WHERE author_id = ?', (os.getpid(),)).scalar()
+                conn.execute("INSERT INTO item (body, done, timestamp, author_id) VALUES (?, 0, datetime('now'), ?)",
+                             ('Item %d' % i, os.getpid()))
+        except OperationalError:
+            errors += 1
+    queue.put(errors)
+
+
+def run(name, pragmas, timeout, workers, writes):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    engine = make_engine(path, pragmas, timeout)
+    engine.execute(SCHEMA)
+    engine.dispose()
+
+    queue = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(path, pragmas, timeout, writes, queue))
+                 for _ in range(workers)]
+    start = time.time()
+    for process in processes:
+        process.start()
+    errors = sum(queue.get() for _ in processes)
+    for process in processes:
+        process.join()
+    seconds = time.time() - start
+    done = workers * writes - errors
+    print('%-10s %8d %8d %10.2f %12.1f' % (name, done, errors, seconds, done / seconds))
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--writes', type=int, default=200)
+    parser.add_argument('--timeout', type=float, default=5, help='默认设置下pysqlite等待锁的秒数')
+    args = parser.parse_args()
+
+    print('%-10s %8s %8s %10s %12s' % ('mode', 'writes', 'locked', 'seconds', 'writes/s'))
+    run('default', {}, args.timeout, args.workers, args.writes)
+    pragmas = Production.TODOISM_SQLITE_PRAGMAS
+    run('tuned', pragmas, pragmas['busy_timeout'] / 1000, args.workers, args.writes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+"""条目集合序列化基准测试
+
+对比旧的逐条序列化(每条调用两次url_for, 懒加载author, jsonify)与
+items_schema(joinedload预加载author, URL模板只生成一次, json_response).
+
+运行: python benchmarks/serialization.py
+"""
+import os
+import sys
+import timeit
+
+from flask import jsonify, url_for
+from sqlalchemy import event
+from sqlalchemy.orm import joinedload
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from todoism import create_app  # noqa
+from todoism.apis.v1.schemas import items_schema, json_response  # noqa
+from todoism.extensions import db  # noqa
+from todoism.modles import User, Item  # noqa
+
+SIZES = (10, 100, 1000)
+REPEAT = 20
+
+
+def legacy_items_schema(items):
+    return [dict(
+        id=item.id,
+        self=url_for('.item', item_id=item.id, _external=True),
+        kind='Item',
+        body=item.body,
+        done=item.done,
+        author=dict(
+            id=item.author_id,
+            url=url_for('.user', _external=True),
+            username=item.author.username,
+            kind='User'
+        )
+    ) for item in items]
+
+
+def legacy(user_id, per_page):
+    db.session.expunge_all()
+    items = Item.query.filter_by(author_id=user_id).order_by(Item.timestamp.desc()).limit(per_page).all()
+    return jsonify(items=legacy_items_schema(items))
+
+
+def batched(user_id, per_page):
+    db.session.expunge_all()
+    items = Item.query.filter_by(author_id=user_id).options(joinedload(Item.author)).order_by(
+        Item.timestamp.desc()).limit(per_page).all()
+    return json_response(items_schema(items, '.items', per_page, None, None, None, count=per_page))
+
+
+def main():
+    app = create_app('testing')
+    with app.test_request_context('/v1/user/items', base_url='http://api.%s' % app.config['SERVER_NAME']):
+        db.create_all()
+        users = []
+        for size in SIZES:
+            user = User(username='bench-%d' % size)
+            db.session.add(user)
+            db.session.add_all(Item(body='Benchmark item %d' % i, author=user) for i in range(size))
+            users.append(user)
+        db.session.commit()
+        user_ids = [user.id for user in users]
+
+        statements = []
+        event.listen(db.engine, 'before_cursor_execute', lambda *args: statements.append(1))
+
+        print('%8s %14s %14s %10s %10s' % ('items', 'legacy (ms)', 'batched (ms)', 'legacy sql', 'batch sql'))
+        for size, user_id in zip(SIZES, user_ids):
+            results = []
+            for func in (legacy, batched):
+                del statements[:]
+                func(user_id, size)
+                count = len(statements)
+                seconds = timeit.timeit(lambda: func(user_id, size), number=REPEAT) / REPEAT
+                results.append((seconds * 1000, count))
+            print('%8d %14.3f %14.3f %10d %10d' % (size, results[0][0], results[1][0], results[0][1], results[1][1]))
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
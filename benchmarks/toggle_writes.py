@@ -0,0 +1,100 @@
+"""切换完成状态的并发写入基准测试
+
+多个线程模拟用户快速勾选条目, 对比逐个读取-修改-提交(每次一个事务)与TODOISM_WRITE_COALESCING
+(单条UPDATE, 时间窗口内的并发写入合并为一次提交)的吞吐量, 提交次数和"database is locked"错误数.
+
+运行: python benchmarks/toggle_writes.py [--threads 16] [--toggles 200] [--window 0.005]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from todoism import create_app  # noqa
+from todoism.extensions import db, group_commit, sqlite_pragmas  # noqa
+from todoism.modles import User, Item, toggle_item_done  # noqa
+from todoism.setting import Production, engine_options  # noqa
+
+ITEMS_PER_USER = 20
+
+
+def legacy(item_id, user_id):
+    item = Item.query.get(item_id)
+    item.done = not item.done
+    db.session.commit()
+
+
+def coalesced(item_id, user_id):
+    toggle_item_done(item_id, user_id)
+
+
+def worker(app, func, targets, toggles, errors):
+    with app.app_context():
+        for i in range(toggles):
+            try:
+                func(*targets[i % len(targets)])
+            except OperationalError:
+                db.session.rollback()
+                errors.append(1)
+        db.session.remove()
+
+
+def run(name, func, app, threads, toggles):
+    with app.app_context():
+        targets = [[(item.id, item.author_id) for item in Item.query.filter_by(author_id=user.id)]
+                   for user in User.query.all()]
+        commits = []
+        event.listen(db.engine, 'commit', lambda conn: commits.append(1))
+    errors = []
+    workers = [threading.Thread(target=worker, args=(app, func, targets[i % len(targets)], toggles, errors))
+               for i in range(threads)]
+    start = time.time()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    seconds = time.time() - start
+    done = threads * toggles - len(errors)
+    print('%-10s %8d %8d %8d %10.2f %12.1f' % (name, done, len(errors), len(commits), seconds, done / seconds))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--toggles', type=int, default=200)
+    parser.add_argument('--window', type=float, default=0.005, help='合并提交的时间窗口(秒)')
+    args = parser.parse_args()
+
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    app = create_app('testing')
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + path
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
+    app.config['TODOISM_GROUP_COMMIT_WINDOW'] = args.window
+    group_commit.init_app(app)
+    with app.app_context():
+        event.listen(db.engine, 'connect', sqlite_pragmas(Production.TODOISM_SQLITE_PRAGMAS))
+        db.create_all()
+        for i in range(args.threads):
+            user = User(username='bench-%d' % i)
+            db.session.add_all(Item(body='Benchmark item %d' % j, author=user) for j in range(ITEMS_PER_USER))
+        db.session.commit()
+
+    print('%-10s %8s %8s %8s %10s %12s' % ('mode', 'toggles', 'locked', 'commits', 'seconds', 'toggles/s'))
+    run('legacy', legacy, app, args.threads, args.toggles)
+    run('coalesced', coalesced, app, args.threads, args.toggles)
+    print('group commit: %(statements)d statements in %(batches)d batches' % group_commit.stats())
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    main()
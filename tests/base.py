@@ -1,34 +1,123 @@
+import os
 from unittest import TestCase
 
 from flask import url_for
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
 
 from todoism import create_app
-from todoism.extensions import db
+from todoism.extensions import db, group_commit, metrics, hashing_pool
 from todoism.modles import User, Item
 
+# transaction: 每个进程只创建一次程序和数据库, 每个测试在SAVEPOINT中运行并在结束时回滚;
+# schema: 每个测试重新建表和写入数据, 用于需要真正提交或修改表结构的测试
+ISOLATION = os.getenv('TODOISM_TEST_ISOLATION', 'transaction')
+PASSWORD = '12345678'
+
+_shared = dict(app=None, password_hash=None, seeded=False)
+
+
+def shared_app():
+    """当前进程共享的测试程序, 内存数据库在每个进程(包括pytest-xdist的每个worker)中相互独立"""
+    if _shared['app'] is None:
+        _shared['app'] = create_app('testing')
+        # 测试用户的密码哈希使用较少的迭代次数, 登录时的校验不再占用大部分测试时间
+        _shared['password_hash'] = generate_password_hash(PASSWORD, 'pbkdf2:sha256:1000')
+    return _shared['app']
+
+
+def seed():
+    """创建数据库表和测试数据, 密码哈希只计算一次"""
+    if _shared['seeded']:
+        return
+    db.create_all()
+    user = User(username='test_user', _password_hash=_shared['password_hash'])
+    item = Item(body='Test Item', done=False, author=user)
+    user2 = User(username='test_user2', _password_hash=_shared['password_hash'])
+    db.session.add_all([user, item, user2])
+    db.session.commit()
+    _shared['seeded'] = True
+
+
+def schema_isolation(test):
+    """让单个测试使用schema模式, 例如通过db.engine直接提交的合并写入"""
+    test.isolation = 'schema'
+    return test
+
 
 class BaseTestCase(TestCase):
+    isolation = ISOLATION
+
     def setUp(self) -> None:
-        app = create_app('testing')
+        app = shared_app()
+        self.config = dict(app.config)
         self.context = app.test_request_context()
         self.context.push()
         self.client = app.test_client()
         self.runner = app.test_cli_runner()
+        # 上一个测试留下的缓存可能指向已回滚的数据
+        for name, extension in app.extensions.items():
+            if name.endswith('_cache'):
+                extension.clear()
+        group_commit.init_app(app)
+        hashing_pool.init_app(app)
+        metrics.reset()
 
-        db.create_all()
-        user = User(username='test_user')
-        user.password = '12345678'
-        item = Item(body='Test Item', done=False, author=user)
-        user2 = User(username='test_user2')
-        user2.password = '12345678'
-        db.session.add_all([user, item, user2])
-        db.session.commit()
+        seed()
+        self.transactional = getattr(getattr(self, self._testMethodName), 'isolation', self.isolation) != 'schema'
+        if self.transactional:
+            self.begin_transaction()
 
     def tearDown(self) -> None:
-        db.drop_all()
+        app = self.context.app
+        if self.transactional:
+            self.rollback_transaction()
+        else:
+            db.session.remove()
+            db.drop_all()
+            _shared['seeded'] = False
+        app.config.clear()
+        app.config.update(self.config)
         self.context.pop()
 
-    def login(self, username='test_user', password='12345678'):
+    def begin_transaction(self):
+        db.session.remove()
+        self.connection = db.engine.connect()
+        # pysqlite自己管理事务时SAVEPOINT不可靠, 测试期间改为由SQLAlchemy发出BEGIN
+        self.dbapi_connection = self.connection.connection.connection
+        self.dbapi_connection.isolation_level = None
+        event.listen(self.connection, 'begin', self.emit_begin)
+        self.transaction = self.connection.begin()
+        self.session_options = dict(db.session.session_factory.kw)
+        db.session.configure(bind=self.connection, binds={})
+        self.session = db.session()
+        self.session.begin_nested()
+        event.listen(self.session, 'after_transaction_end', self.restart_savepoint)
+
+    def rollback_transaction(self):
+        event.remove(self.session, 'after_transaction_end', self.restart_savepoint)
+        self.session.rollback()
+        db.session.remove()
+        event.remove(self.connection, 'begin', self.emit_begin)
+        # 被测代码关闭会话(例如事件流)时SAVEPOINT仍留在连接上, 这时直接回滚最外层的事务会让SQLAlchemy警告
+        # reset agent不一致并使连接失效; 关闭连接时连接池会回滚整个事务, 包括留下的SAVEPOINT
+        self.connection.close()
+        self.dbapi_connection.isolation_level = ''
+        db.session.session_factory.kw.clear()
+        db.session.session_factory.kw.update(self.session_options)
+
+    @staticmethod
+    def emit_begin(connection):
+        connection.execute('BEGIN')
+
+    @staticmethod
+    def restart_savepoint(session, transaction):
+        # 被测代码提交或回滚只结束SAVEPOINT, 重新开始一个保证后续修改仍能回滚
+        if transaction.nested and not transaction._parent.nested:
+            session.expire_all()
+            session.begin_nested()
+
+    def login(self, username='test_user', password=PASSWORD):
         return self.client.post(url_for('auth.login'), json=dict(
             username=username,
             password=password
@@ -37,7 +126,7 @@ class BaseTestCase(TestCase):
     def logout(self):
         return self.client.get(url_for('auth.logout'))
 
-    def get_oauth_token(self, username='test_user', password='12345678'):
+    def get_oauth_token(self, username='test_user', password=PASSWORD):
         response = self.client.post(url_for('api_v1.token'), data=dict(
             grant_type='password',
             username=username,
@@ -1,8 +1,19 @@
-from flask import url_for
+import csv
+import io
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest import mock
 
-from todoism.extensions import db
-from todoism.modles import Item, User
-from .base import BaseTestCase
+from flask import url_for, current_app
+
+from todoism.caching import Cache
+from todoism.extensions import db, token_cache, hashing_pool
+from todoism.modles import Item, User, RefreshToken
+from todoism.search import search_items, search_tokenizer
+from todoism.security import HashingPoolBusy
+from .base import BaseTestCase, schema_isolation
 
 
 class ApiV1TestCase(BaseTestCase):
@@ -45,6 +56,79 @@ class ApiV1TestCase(BaseTestCase):
         self.assertNotIn('expires_in', data)
         self.assertIn('username or password was invalid', data['message'])
 
+    def test_refresh_token(self):
+        current_app.config['TODOISM_ACCESS_TOKEN_EXPIRATION'] = 60
+        data = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='password', username='test_user', password='12345678')).get_json()
+        self.assertEqual(data['expires_in'], 60)
+        refresh_token = data['refresh_token']
+
+        response = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='refresh_token', refresh_token=refresh_token))
+        data = response.get_json()
+        self.assertEqual(response.headers['Cache-Control'], 'no-store')
+        response = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(data['access_token']))
+        self.assertEqual(response.get_json()['username'], 'test_user')
+        self.assertNotEqual(data['refresh_token'], refresh_token)
+
+        # 重复使用已轮换的令牌时撤销该用户的所有令牌
+        response = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='refresh_token', refresh_token=refresh_token))
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='refresh_token', refresh_token=data['refresh_token']))
+        self.assertIn('The refresh token was invalid.', response.get_json()['message'])
+
+        data = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='password', username='test_user', password='12345678')).get_json()
+        response = self.client.post(url_for('api_v1.revoke_token'), data=dict(token=data['refresh_token']))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='refresh_token', refresh_token=data['refresh_token']))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.post(url_for('api_v1.revoke_token'), data=dict(token='bad')).status_code, 200)
+
+    def test_concurrent_refresh(self):
+        data = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='password', username='test_user', password='12345678')).get_json()
+        stale = RefreshToken.find(data['refresh_token'])
+        db.session.expunge(stale)
+        self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='refresh_token', refresh_token=data['refresh_token']))
+        # 并发的请求在另一个请求撤销之前读取了令牌
+        with mock.patch.object(RefreshToken, 'find', return_value=stale):
+            response = self.client.post(url_for('api_v1.token'), data=dict(
+                grant_type='refresh_token', refresh_token=data['refresh_token']))
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(RefreshToken.query.filter(RefreshToken.revoked_at.is_(None)).count(), 0)
+
+    def test_hashing_pool_busy(self):
+        hashing_pool.max_pending = 0
+        response = self.client.post(url_for('api_v1.token'), data=dict(
+            grant_type='password', username='test_user', password='12345678'))
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_hashing_pool_timeout(self):
+        hashing_pool.max_pending = 1
+        hashing_pool.timeout = 0.01
+        finished = threading.Event()
+        with self.assertRaises(HashingPoolBusy):
+            hashing_pool._run(finished.wait, 5)
+        # 超时的哈希仍在计算, 继续占用名额
+        with self.assertRaises(HashingPoolBusy):
+            hashing_pool._run(len, '')
+        finished.set()
+        hashing_pool.timeout = 5
+        for _ in range(100):
+            try:
+                self.assertEqual(hashing_pool._run(len, 'ok'), 2)
+                break
+            except HashingPoolBusy:
+                time.sleep(0.01)
+        else:
+            self.fail('名额没有释放')
+
     def test_get_user(self):
         token = self.get_oauth_token()
         response = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(token))
@@ -91,6 +175,30 @@ class ApiV1TestCase(BaseTestCase):
         self.assertEqual(response.status_code, 403)
         self.assertIn('Forbidden', response.get_json().get('message'))
 
+    @schema_isolation
+    def test_patch_item_coalesced(self):
+        current_app.config['TODOISM_WRITE_COALESCING'] = True
+        token = self.get_oauth_token()
+        etag = self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token)).headers['ETag']
+        response = self.client.patch(url_for('api_v1.item', item_id=1), headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 204)
+        self.assertTrue(Item.query.get(1).done)
+        data = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(token)).get_json()
+        self.assertEqual(data['active_item_count'], 0)
+        self.assertEqual(data['completed_item_count'], 1)
+        response = self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token))
+        self.assertNotEqual(response.headers['ETag'], etag)
+
+        self.client.patch(url_for('api_v1.item', item_id=1), headers=self.set_auth_header(token))
+        self.assertFalse(Item.query.get(1).done)
+        self.assertEqual(User.query.get(1).active_count, 1)
+
+        token = self.get_oauth_token('test_user2')
+        response = self.client.patch(url_for('api_v1.item', item_id=1), headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 403)
+        response = self.client.patch(url_for('api_v1.item', item_id=42), headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 404)
+
     def test_delete_item(self):
         token = self.get_oauth_token('test_user2')
         response = self.client.delete(url_for('api_v1.item', item_id=1), headers=self.set_auth_header(token))
@@ -116,6 +224,9 @@ class ApiV1TestCase(BaseTestCase):
         data = response.get_json()
         self.assertEqual('ItemCollection', data['kind'])
         self.assertEqual(data['count'], 3)
+        for item in data['items']:
+            self.assertEqual(item['self'], url_for('api_v1.item', item_id=item['id'], _external=True))
+            self.assertEqual(item['author']['username'], 'test_user')
 
     def test_post_items(self):
         token = self.get_oauth_token()
@@ -166,3 +277,319 @@ class ApiV1TestCase(BaseTestCase):
         self.assertEqual(response.status_code, 204)
         self.assertEqual(Item.query.count(), 2)
 
+
+    def test_get_items_with_cursor(self):
+        user = User.query.get(1)
+        for i in range(4):
+            db.session.add(Item(body='Cursor item %d' % i, author=user))
+        db.session.commit()
+        token = self.get_oauth_token()
+        response = self.client.get(url_for('api_v1.items', cursor='', per_page=2), headers=self.set_auth_header(token))
+        data = response.get_json()
+        self.assertEqual(len(data['items']), 2)
+        self.assertIsNone(data['count'])
+        self.assertIsNone(data['last'])
+        self.assertIn('cursor=', data['next'])
+
+        seen = [item['id'] for item in data['items']]
+        while data['next'] is not None:
+            data = self.client.get(data['next'], headers=self.set_auth_header(token)).get_json()
+            seen.extend(item['id'] for item in data['items'])
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+
+        response = self.client.get(url_for('api_v1.items', after='', with_count=1),
+                                   headers=self.set_auth_header(token))
+        self.assertEqual(response.get_json()['count'], 5)
+
+        response = self.client.get(url_for('api_v1.items', cursor='bad'), headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 400)
+
+        for per_page in (0, -1):
+            data = self.client.get(url_for('api_v1.items', cursor='', per_page=per_page),
+                                   headers=self.set_auth_header(token)).get_json()
+            self.assertEqual(len(data['items']), 1)
+        data = self.client.get(url_for('api_v1.items', per_page=1000), headers=self.set_auth_header(token)).get_json()
+        self.assertIn('per_page=%d' % current_app.config['TODOISM_MAX_PER_PAGE'], data['self'])
+
+    def test_user_item_counts(self):
+        token = self.get_oauth_token()
+        self.client.post(url_for('api_v1.items'), json={'body': 'count item'}, headers=self.set_auth_header(token))
+        self.client.patch(url_for('api_v1.item', item_id=1), headers=self.set_auth_header(token))
+        data = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(token)).get_json()
+        self.assertEqual(data['all_item_count'], 2)
+        self.assertEqual(data['active_item_count'], 1)
+        self.assertEqual(data['completed_item_count'], 1)
+
+        self.client.delete(url_for('api_v1.complete_items'), headers=self.set_auth_header(token))
+        self.client.delete(url_for('api_v1.item', item_id=2), headers=self.set_auth_header(token))
+        data = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(token)).get_json()
+        self.assertEqual(data['all_item_count'], 0)
+        self.assertEqual(data['active_item_count'], 0)
+
+    def test_batch_items(self):
+        user2 = User.query.get(2)
+        db.session.add(Item(body='Other Item', author=user2))
+        db.session.commit()
+        token = self.get_oauth_token()
+        response = self.client.post(url_for('api_v1.batch_items'), json={'operations': [
+            {'op': 'create', 'body': 'Batch Item'},
+            {'op': 'create', 'body': ''},
+            {'op': 'update', 'id': 1, 'body': 'Batch Update'},
+            {'op': 'toggle', 'id': 1},
+            {'op': 'toggle', 'id': 2},
+            {'op': 'delete', 'id': 99},
+            {'op': 'unknown'},
+        ]}, headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 200)
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results], [201, 400, 200, 200, 403, 404, 400])
+        self.assertEqual(results[0]['item']['body'], 'Batch Item')
+        self.assertTrue(results[3]['item']['done'])
+        item = Item.query.get(1)
+        self.assertEqual(item.body, 'Batch Update')
+        self.assertTrue(item.done)
+
+        new_id = results[0]['id']
+        response = self.client.post(url_for('api_v1.batch_items'), json={'operations': [
+            {'op': 'delete', 'id': 1},
+            {'op': 'delete', 'id': new_id},
+            {'op': 'toggle', 'id': 1},
+        ]}, headers=self.set_auth_header(token))
+        results = response.get_json()['results']
+        self.assertEqual([result['status'] for result in results], [204, 204, 404])
+        self.assertEqual(Item.query.with_parent(User.query.get(1)).count(), 0)
+        user = User.query.get(1)
+        self.assertEqual(user.all_count, 0)
+        self.assertEqual(user.active_count, 0)
+
+        response = self.client.post(url_for('api_v1.batch_items'), json={'operations': []},
+                                    headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 400)
+
+    def test_token_cache(self):
+        token = self.get_oauth_token()
+        hits = token_cache.hits
+        response = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(token))
+        self.assertEqual(response.get_json().get('username'), 'test_user')
+        response = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(token))
+        self.assertEqual(response.get_json().get('username'), 'test_user')
+        self.assertEqual(response.get_json().get('all_item_count'), 1)
+        self.assertEqual(token_cache.hits, hits + 1)
+        self.assertIsNotNone(token_cache.get(token))
+
+        # 其他进程的写入不会清除这个进程的缓存, 计数仍然从数据库读取
+        db.session.execute(User.__table__.update().where(User.id == 1).values(all_count=5))
+        db.session.expunge_all()
+        response = self.client.get(url_for('api_v1.user'), headers=self.set_auth_header(token))
+        self.assertEqual(response.get_json().get('all_item_count'), 5)
+        self.assertEqual(token_cache.hits, hits + 3)
+
+        # 条目的写操作只修改计数, 不清除缓存
+        self.client.post(url_for('api_v1.items'), json={'body': 'Cached'}, headers=self.set_auth_header(token))
+        self.assertIsNotNone(token_cache.get(token))
+
+        user = User.query.get(1)
+        user.password = 'new-password'
+        db.session.commit()
+        self.assertIsNone(token_cache.get(token))
+
+    def test_shared_cache_backend(self):
+        class Backend(dict):
+            def set(self, key, value, timeout=None):
+                self[key] = value
+
+            def delete(self, key):
+                self.pop(key, None)
+
+        backend = Backend()
+        first, second = Cache('shared'), Cache('shared')
+        first.backend = second.backend = backend
+        for index in range(100):
+            first.set(index, 'value', tags=('user:1',))
+        self.assertEqual(second.get(1), 'value')
+        # 标签只保存一个版本号, 不随条目数量增长
+        self.assertEqual(len(backend), 101)
+        first.delete_tag('user:1')
+        self.assertIsNone(second.get(1))
+        second.set(1, 'new', tags=('user:1',))
+        self.assertEqual(first.get(1), 'new')
+        self.assertIsNone(first.get(2))
+
+    def test_export_items(self):
+        user = User.query.get(1)
+        db.session.add(Item(body='Export, "quoted"', done=True, author=user))
+        db.session.commit()
+        token = self.get_oauth_token()
+        response = self.client.get(url_for('api_v1.export_items'), headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data(as_text=True).splitlines()]
+        self.assertEqual([line['body'] for line in lines], ['Test Item', 'Export, "quoted"'])
+
+        response = self.client.get(url_for('api_v1.export_items', format='csv'), headers=self.set_auth_header(token))
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows[0], ['id', 'body', 'done', 'timestamp'])
+        self.assertEqual(rows[2][1:3], ['Export, "quoted"', '1'])
+
+        headers = self.set_auth_header(token)
+        headers['If-Modified-Since'] = response.headers['Last-Modified']
+        response = self.client.get(url_for('api_v1.export_items'), headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        response = self.client.get(url_for('api_v1.export_items', format='xml'), headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 400)
+
+    def test_import_items(self):
+        token = self.get_oauth_token()
+        headers = self.set_auth_header(token)
+        headers['Content-Type'] = 'application/x-ndjson'
+        data = '{"body": "Imported 1"}\n{"body": "Imported 2", "done": true}\n'
+        response = self.client.post(url_for('api_v1.import_items'), data=data, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['imported'], 2)
+        user = User.query.get(1)
+        self.assertEqual(user.all_count, 3)
+        self.assertEqual(user.active_count, 2)
+
+        response = self.client.post(url_for('api_v1.import_items', chunk_size=1), data='{"body": "Ok"}\nnot json\n',
+                                    headers=headers)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.get_json()['imported'], 1)
+        self.assertEqual(response.get_json()['resume_from'], 1)
+
+    def test_conditional_get(self):
+        token = self.get_oauth_token()
+        response = self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token))
+        etag = response.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+
+        headers = self.set_auth_header(token)
+        headers['If-None-Match'] = etag
+        response = self.client.get(url_for('api_v1.items'), headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.get_data(), b'')
+        # 单个条目使用自己的ETag, 不存在或不属于当前用户的条目不会返回304
+        response = self.client.get(url_for('api_v1.item', item_id=1), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        item_headers = self.set_auth_header(token)
+        item_headers['If-None-Match'] = response.headers['ETag']
+        response = self.client.get(url_for('api_v1.item', item_id=1), headers=item_headers)
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get(url_for('api_v1.item', item_id=99), headers=headers)
+        self.assertEqual(response.status_code, 404)
+        other_headers = self.set_auth_header(self.get_oauth_token('test_user2'))
+        other_headers['If-None-Match'] = item_headers['If-None-Match']
+        response = self.client.get(url_for('api_v1.item', item_id=1), headers=other_headers)
+        self.assertEqual(response.status_code, 403)
+
+        # 其他进程的写入不会清除这个进程的缓存, 条目版本仍然从数据库读取
+        db.session.execute(User.__table__.update().where(User.id == 1).values(item_version=User.item_version + 1))
+        response = self.client.get(url_for('api_v1.items'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        headers['If-None-Match'] = etag
+
+        self.client.put(url_for('api_v1.item', item_id=1), json={'body': 'Changed'},
+                        headers=self.set_auth_header(token))
+        response = self.client.get(url_for('api_v1.items'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(response.get_json()['items'][0]['body'], 'Changed')
+        response = self.client.get(url_for('api_v1.item', item_id=1), headers=item_headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['body'], 'Changed')
+
+        response = self.client.get(url_for('api_v1.item', item_id=99), headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 404)
+        self.assertNotIn('ETag', response.headers)
+
+    def test_search_items(self):
+        user = User.query.get(1)
+        db.session.add_all([
+            Item(body='Buy milk and bread', author=user),
+            Item(body='Buy milk', author=user),
+            Item(body='买牛奶和面包', author=user),
+            Item(body='Buy milk', author=User.query.get(2))
+        ])
+        db.session.commit()
+        token = self.get_oauth_token()
+        headers = self.set_auth_header(token)
+        data = self.client.get(url_for('api_v1.search_items', q='milk'), headers=headers).get_json()
+        self.assertEqual(data['count'], 2)
+        self.assertEqual(data['items'][0]['body'], 'Buy milk')
+        data = self.client.get(url_for('api_v1.search_items', q='milk bread', per_page=1), headers=headers).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['Buy milk and bread'])
+        self.assertIsNone(data['next'])
+        self.assertIn('q=milk', data['first'])
+        data = self.client.get(url_for('api_v1.search_items', q='牛奶'), headers=headers).get_json()
+        self.assertEqual(data['count'], 1)
+        data = self.client.get(url_for('api_v1.search_items', q='"milk'), headers=headers).get_json()
+        self.assertEqual(data['count'], 0)
+
+        item = Item.query.filter_by(body='Buy milk', author=user).first()
+        self.client.put(url_for('api_v1.item', item_id=item.id), json={'body': 'Buy eggs'}, headers=headers)
+        self.client.delete(url_for('api_v1.item', item_id=item.id - 1), headers=headers)
+        data = self.client.get(url_for('api_v1.search_items', q='milk'), headers=headers).get_json()
+        self.assertEqual(data['count'], 0)
+        data = self.client.get(url_for('api_v1.search_items', q='eggs'), headers=headers).get_json()
+        self.assertEqual(data['count'], 1)
+        response = self.client.get(url_for('api_v1.search_items', q=' '), headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+    @schema_isolation
+    def test_search_without_tokenizer(self):
+        # 旧版SQLite没有trigram分词器或没有编译FTS5时仍然可以建表和搜索
+        db.drop_all()
+        current_app.config['TODOISM_SEARCH_TOKENIZER'] = 'missing'
+        db.create_all()
+        self.assertEqual(search_tokenizer(), 'unicode61')
+        db.drop_all()
+        with mock.patch('todoism.search.fts5_supports', return_value=False):
+            db.create_all()
+            user = User(username='search_user')
+            db.session.add_all([Item(body='Buy milk', author=user), Item(body='买牛奶', author=user)])
+            db.session.commit()
+            self.assertEqual(search_items(Item.query, '牛奶').one().body, '买牛奶')
+        self.assertNotIn('item_fts', db.engine.table_names())
+
+    def test_item_changes(self):
+        token = self.get_oauth_token()
+        headers = self.set_auth_header(token)
+        data = self.client.get(url_for('api_v1.item_changes'), headers=headers).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['Test Item'])
+        self.assertEqual(data['deleted'], [])
+        since = data['since']
+
+        item = Item.query.get(1)
+        item.updated_at = item.timestamp = datetime.utcnow() - timedelta(minutes=1)
+        db.session.commit()
+        data = self.client.get(url_for('api_v1.item_changes', since=since), headers=headers).get_json()
+        self.assertEqual(data['items'], [])
+
+        self.client.patch(url_for('api_v1.item', item_id=1), headers=headers)
+        self.client.post(url_for('api_v1.items'), json={'body': 'New item'}, headers=headers)
+        response = self.client.post(url_for('api_v1.items'), json={'body': 'Deleted item'}, headers=headers)
+        deleted_id = response.get_json()['id']
+        self.client.delete(url_for('api_v1.item', item_id=deleted_id), headers=headers)
+        data = self.client.get(url_for('api_v1.item_changes', since=since, limit=1), headers=headers).get_json()
+        self.assertTrue(data['has_more'])
+        self.assertEqual(data['items'][0]['id'], 1)
+        self.assertTrue(data['items'][0]['done'])
+        # 修改和删除一起分页, 每页最多limit条
+        items, deleted = [], []
+        while data['has_more']:
+            data = self.client.get(data['next'], headers=headers).get_json()
+            self.assertLessEqual(len(data['items']) + len(data['deleted']), 1)
+            items.extend(item['body'] for item in data['items'])
+            deleted.extend(data['deleted'])
+        self.assertEqual(items, ['New item'])
+        self.assertEqual(deleted, [deleted_id])
+
+        for limit in (0, -1):
+            data = self.client.get(url_for('api_v1.item_changes', since=since, limit=limit), headers=headers).get_json()
+            self.assertTrue(data['has_more'])
+            self.assertEqual(len(data['items']), 1)
+
+        response = self.client.get(url_for('api_v1.item_changes', since='bad'), headers=headers)
+        self.assertEqual(response.status_code, 400)
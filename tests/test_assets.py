@@ -0,0 +1,77 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+from flask import url_for, current_app
+
+from todoism.extensions import assets
+from .base import BaseTestCase
+
+
+class AssetsTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        super(AssetsTestCase, self).setUp()
+        self.static_folder = current_app.static_folder
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'css'))
+        with open(os.path.join(self.directory, 'css', 'style.css'), 'w') as f:
+            f.write('body { color: #333; }\n' * 100)
+        with open(os.path.join(self.directory, 'demo.png'), 'wb') as f:
+            f.write(b'\x89PNG')
+        current_app.static_folder = self.directory
+
+    def tearDown(self) -> None:
+        current_app.static_folder = self.static_folder
+        assets.load(None, self.static_folder)
+        shutil.rmtree(self.directory)
+        super(AssetsTestCase, self).tearDown()
+
+    def test_compress_response(self):
+        current_app.config['TODOISM_COMPRESS_MIN_SIZE'] = 100
+        token = self.get_oauth_token()
+        headers = self.set_auth_header(token)
+        response = self.client.get(url_for('api_v1.items'), headers=headers)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.vary)
+
+        headers['Accept-Encoding'] = 'gzip'
+        compressed = self.client.get(url_for('api_v1.items'), headers=headers)
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.get_data()), response.get_data())
+        self.assertTrue(compressed.headers['ETag'].startswith('W/'))
+
+        current_app.config['TODOISM_COMPRESS_MIN_SIZE'] = 100000
+        response = self.client.get(url_for('api_v1.items'), headers=headers)
+        self.assertNotIn('Content-Encoding', response.headers)
+
+    def test_build(self):
+        result = self.runner.invoke(args=['assets', 'build'])
+        self.assertIn('Done!', result.output)
+        manifest = os.path.join(self.directory, 'dist', 'manifest.json')
+        self.assertTrue(os.path.exists(manifest))
+
+        assets.load(manifest, self.directory)
+        hashed = assets.manifest['css/style.css']
+        self.assertRegex(hashed, r'^dist/css/style\.[0-9a-f]{12}\.css$')
+        self.assertTrue(os.path.exists(os.path.join(self.directory, hashed + '.gz')))
+        # 图片不再压缩
+        self.assertFalse(os.path.exists(os.path.join(self.directory, assets.manifest['demo.png'] + '.gz')))
+        self.assertTrue(url_for('static', filename='css/style.css').endswith(hashed))
+
+        response = self.client.get(url_for('static', filename='css/style.css'),
+                                   headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(response.cache_control.max_age, current_app.config['TODOISM_ASSET_MAX_AGE'])
+        self.assertIn('color: #333', gzip.decompress(response.get_data()).decode())
+        response.close()
+
+        response = self.client.get(url_for('static', filename='css/style.css'))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('color: #333', response.get_data(as_text=True))
+        response.close()
+
+        self.runner.invoke(args=['assets', 'clean'])
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'dist')))
@@ -1,5 +1,11 @@
+import os
+import tempfile
+
 from flask import current_app
+from sqlalchemy import create_engine, event
 
+from todoism.extensions import sqlite_pragmas
+from todoism.setting import Production, engine_options
 from .base import BaseTestCase
 
 
@@ -13,3 +19,22 @@ class BasicTestCase(BaseTestCase):
     def test_404(self):
         response = self.client.get('/nothing', follow_redirects=True)
         self.assertIn('The requested URL was not found on the server', response.get_data(as_text=True))
+
+    def test_sqlite_pragmas(self):
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        engine = create_engine('sqlite:///' + path)
+        event.listen(engine, 'connect', sqlite_pragmas(Production.TODOISM_SQLITE_PRAGMAS))
+        try:
+            self.assertEqual(engine.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(engine.execute('PRAGMA busy_timeout').scalar(),
+                             Production.TODOISM_SQLITE_PRAGMAS['busy_timeout'])
+        finally:
+            engine.dispose()
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+
+    def test_engine_options(self):
+        self.assertIn('connect_args', engine_options('sqlite:///data.db'))
+        self.assertTrue(engine_options('postgresql://localhost/todoism')['pool_pre_ping'])
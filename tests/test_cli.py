@@ -1,8 +1,15 @@
+import json
+
 from todoism.extensions import db
+from todoism.modles import User, Item, RefreshToken
+from todoism.search import search_items
 from .base import BaseTestCase
 
 
 class CliTestCase(BaseTestCase):
+    # 命令会删除和重新创建数据库表
+    isolation = 'schema'
+
     def setUp(self) -> None:
         super(CliTestCase, self).setUp()
         db.drop_all()
@@ -16,3 +23,110 @@ class CliTestCase(BaseTestCase):
         self.assertIn('这将清空整个数据库, 你确定吗', result.output)
         self.assertIn('数据库清理完毕', result.output)
         self.assertIn('Done!', result.output)
+
+    def test_rebuild_counts(self):
+        self.runner.invoke(args=['init-db'])
+        user = User(username='count_user')
+        db.session.add_all([user, Item(body='Item 1', author=user), Item(body='Item 2', done=True, author=user)])
+        db.session.commit()
+        User.query.update({User.all_count: 0, User.active_count: 0})
+        db.session.commit()
+
+        result = self.runner.invoke(args=['rebuild-counts'])
+        self.assertIn('Done!', result.output)
+        user = User.query.filter_by(username='count_user').first()
+        self.assertEqual(user.all_count, 2)
+        self.assertEqual(user.active_count, 1)
+
+    def test_import_items(self):
+        self.runner.invoke(args=['init-db'])
+        user = User(username='import_user')
+        db.session.add(user)
+        db.session.commit()
+        with self.runner.isolated_filesystem():
+            with open('items.csv', 'w', encoding='utf-8') as f:
+                f.write('body,done\nItem 1,0\nItem 2,1\n,0\nItem 4,0\n')
+            result = self.runner.invoke(args=['import-items', 'items.csv', '--username', 'import_user',
+                                              '--format', 'csv', '--chunk-size', '2'])
+            self.assertNotEqual(result.exit_code, 0)
+            self.assertIn('导入2条', result.output)
+            self.assertIn('--skip 2', result.output)
+
+            with open('items.csv', 'w', encoding='utf-8') as f:
+                f.write('body,done\nItem 1,0\nItem 2,1\nItem 3,0\nItem 4,0\n')
+            result = self.runner.invoke(args=['import-items', 'items.csv', '--username', 'import_user',
+                                              '--format', 'csv', '--skip', '2'])
+            self.assertIn('Done!', result.output)
+        user = User.query.filter_by(username='import_user').first()
+        self.assertEqual(Item.query.with_parent(user).count(), 4)
+        self.assertEqual(user.all_count, 4)
+        self.assertEqual(user.active_count, 3)
+
+    def test_profile(self):
+        self.runner.invoke(args=['init-db'])
+        user = User(username='profile_user')
+        user.password = '12345678'
+        db.session.add(user)
+        db.session.commit()
+        result = self.runner.invoke(args=['profile', '/v1/user/items', '--username', 'profile_user', '--count', '2'])
+        self.assertIn('状态码: 200 x 2', result.output)
+        self.assertIn('function calls', result.output)
+        result = self.runner.invoke(args=['profile', '/app', '--username', 'profile_user', '--count', '1'])
+        self.assertIn('状态码: 200 x 1', result.output)
+        result = self.runner.invoke(args=['profile', '/app', '--username', 'nobody'])
+        self.assertIn('用户不存在', result.output)
+
+    def test_prune_tokens(self):
+        self.runner.invoke(args=['init-db'])
+        user = User(username='token_user')
+        RefreshToken.issue(user, 60)
+        RefreshToken.issue(user, -60)
+        db.session.commit()
+        result = self.runner.invoke(args=['prune-tokens'])
+        self.assertIn('删除了1个令牌', result.output)
+        self.assertEqual(RefreshToken.query.count(), 1)
+
+    def test_seed_and_bench(self):
+        self.runner.invoke(args=['init-db'])
+        result = self.runner.invoke(args=['bench'])
+        self.assertIn('flask seed', result.output)
+        result = self.runner.invoke(args=['seed', '--users', '2', '--items-per-user', '5'])
+        self.assertIn('生成2个用户, 10个条目', result.output)
+        self.assertEqual(Item.query.count(), 10)
+        self.assertEqual(sum(user.all_count for user in User.query), 10)
+
+        result = self.runner.invoke(args=['bench', '--scenario', 'app', '--scenario', 'api_item', '--requests', '3',
+                                          '--concurrency', '1'])
+        data = json.loads(result.output)
+        self.assertEqual(sorted(data['scenarios']), ['api_item', 'app'])
+        self.assertEqual(data['scenarios']['app']['requests'], 3)
+        self.assertEqual(data['scenarios']['app']['errors'], 0)
+        self.assertGreater(data['scenarios']['api_item']['sql_per_request'], 0)
+
+    def test_upgrade_db(self):
+        for ddl in ('CREATE TABLE user (id INTEGER PRIMARY KEY, username VARCHAR(30) UNIQUE, '
+                    '_password_hash VARCHAR(128), locale VARCHAR(20))',
+                    'CREATE TABLE item (id INTEGER PRIMARY KEY, body TEXT, done BOOLEAN, timestamp DATETIME, '
+                    'author_id INTEGER REFERENCES user(id))',
+                    'CREATE INDEX ix_item_timestamp ON item (timestamp)',
+                    "INSERT INTO user (id, username) VALUES (1, 'old_user')",
+                    "INSERT INTO item (body, done, timestamp, author_id) "
+                    "VALUES ('Old 1', 0, '2019-01-01 08:00:00', 1)",
+                    "INSERT INTO item (body, done, timestamp, author_id) "
+                    "VALUES ('Old 2', 1, '2019-01-02 08:00:00', 1)"):
+            db.session.execute(ddl)
+        db.session.commit()
+
+        result = self.runner.invoke(args=['upgrade-db'])
+        self.assertIn('添加列 user.all_count', result.output)
+        self.assertIn('添加索引 ix_item_author_id_done_timestamp', result.output)
+        self.assertIn('Done!', result.output)
+        user = User.query.get(1)
+        self.assertEqual(user.all_count, 2)
+        self.assertEqual(user.active_count, 1)
+        self.assertIsNotNone(Item.query.get(1).updated_at)
+        self.assertEqual(search_items(Item.query, 'Old').count(), 2)
+
+        result = self.runner.invoke(args=['upgrade-db'])
+        self.assertNotIn('添加', result.output)
+        self.assertIn('Done!', result.output)
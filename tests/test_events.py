@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+
+from flask import url_for, current_app
+
+from todoism.events import EventBroker, SocketTransport
+from todoism.extensions import event_broker
+from .base import BaseTestCase, schema_isolation
+
+
+def read_event(response):
+    """读取事件流中的下一个事件, 跳过retry和心跳"""
+    for chunk in response.response:
+        chunk = chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        if chunk.startswith('event: '):
+            event, data = chunk.strip().split('\n')
+            return event[len('event: '):], json.loads(data[len('data: '):])
+    return None
+
+
+class EventsTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        super(EventsTestCase, self).setUp()
+        current_app.config['TODOISM_EVENT_HEARTBEAT'] = 0.01
+
+    def test_api_events(self):
+        token = self.get_oauth_token()
+        headers = self.set_auth_header(token)
+        response = self.client.get(url_for('api_v1.item_events'), headers=headers, buffered=False)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertEqual(event_broker.stats()['connections'], 1)
+
+        # 事件流打开期间它的请求上下文仍在栈顶, 其他子域名的URL需要生成完整地址
+        headers['X-Client-Id'] = 'tab-1'
+        item = self.client.post(url_for('api_v1.items', _external=True), json=dict(body='Pushed Item'),
+                                headers=headers).get_json()
+        event, data = read_event(response)
+        self.assertEqual(event, 'change')
+        self.assertEqual(data['origin'], 'tab-1')
+        self.assertEqual(data['created'], [dict(id=item['id'], body='Pushed Item', done=False)])
+        self.assertEqual(data['counts'], [1, 1])
+
+        self.client.patch(url_for('api_v1.item', item_id=item['id'], _external=True), headers=headers)
+        event, data = read_event(response)
+        self.assertEqual(data['updated'], [dict(id=item['id'], body='Pushed Item', done=True)])
+        self.assertEqual(data['counts'], [0, -1])
+
+        self.client.delete(url_for('api_v1.complete_items', _external=True), headers=headers)
+        event, data = read_event(response)
+        self.assertEqual(data['deleted'], [item['id']])
+        self.assertEqual(data['counts'], [-1, 0])
+
+        self.assertEqual(next(iter(response.response)), b': ping\n\n')
+        response.close()
+        self.assertEqual(event_broker.stats()['connections'], 0)
+
+    def test_web_events(self):
+        self.login()
+        response = self.client.get(url_for('todo.events'), buffered=False)
+        self.client.post(url_for('todo.new_item'), json=dict(body='Pushed Item'))
+        event, data = read_event(response)
+        self.assertIn('Pushed Item', data['created'][0]['html'])
+        self.assertIn('data-id="%d"' % data['created'][0]['id'], data['created'][0]['html'])
+
+        self.client.post(url_for('api_v1.import_items', _external=True), data='{"body": "Imported"}\n',
+                         headers=self.set_auth_header(self.get_oauth_token()))
+        self.assertEqual(read_event(response)[0], 'resync')
+        response.close()
+
+    def test_other_users_events(self):
+        self.login('test_user2')
+        response = self.client.get(url_for('todo.events'), buffered=False)
+        self.logout()
+        self.login()
+        self.client.post(url_for('todo.new_item'), json=dict(body='Pushed Item'))
+        self.assertEqual(next(iter(response.response)), b'retry: 3000\n\n')
+        self.assertEqual(next(iter(response.response)), b': ping\n\n')
+        response.close()
+
+    @schema_isolation
+    def test_coalesced_toggle_event(self):
+        current_app.config['TODOISM_WRITE_COALESCING'] = True
+        self.login()
+        subscription = event_broker.subscribe(1)
+        try:
+            self.client.patch(url_for('todo.toggle_item', item_id=1))
+            event, data = subscription.get(0)
+        finally:
+            event_broker.unsubscribe(subscription)
+        self.assertEqual(data['updated'], [dict(id=1, body='Test Item', done=True)])
+        self.assertEqual(data['counts'], [0, -1])
+
+    def test_batch_delete_event(self):
+        token = self.get_oauth_token()
+        subscription = event_broker.subscribe(1)
+        try:
+            self.client.post(url_for('api_v1.batch_items'), json={'operations': [{'op': 'delete', 'id': 1}]},
+                             headers=self.set_auth_header(token))
+            event, data = subscription.get(0)
+        finally:
+            event_broker.unsubscribe(subscription)
+        self.assertEqual(event, 'change')
+        self.assertEqual(data['deleted'], [1])
+        self.assertEqual(data['counts'], [-1, -1])
+
+    def test_too_many_connections(self):
+        max_connections = event_broker.max_connections
+        event_broker.max_connections = 0
+        try:
+            response = self.client.get(url_for('api_v1.item_events'),
+                                       headers=self.set_auth_header(self.get_oauth_token()))
+        finally:
+            event_broker.max_connections = max_connections
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+    def test_overflow_and_timeout(self):
+        broker = EventBroker()
+        broker.queue_size = 1
+        subscription = broker.subscribe(1)
+        broker.publish(1, 'change', dict(n=1))
+        broker.publish(1, 'change', dict(n=2))
+        chunks = list(broker.stream(subscription, 0.01, 1))
+        self.assertEqual(chunks[-1], 'event: resync\ndata: {}\n\n')
+        self.assertEqual(broker.stats(), dict(connections=0, users=0))
+
+        chunks = list(broker.stream(broker.subscribe(1), 0.01, 0.03))
+        self.assertIn(': ping\n\n', chunks)
+        self.assertEqual(chunks[-1], 'event: reconnect\ndata: {}\n\n')
+
+    def test_socket_transport(self):
+        directory = tempfile.mkdtemp()
+        publisher, receiver = EventBroker(), EventBroker()
+        publisher.transport, receiver.transport = SocketTransport(directory), SocketTransport(directory)
+        try:
+            publisher.transport.listen(publisher.deliver)
+            receiver.transport.listen(receiver.deliver)
+            # 已退出的进程留下的套接字文件
+            open(os.path.join(directory, 'stale.sock'), 'w').close()
+            subscription = receiver.subscribe(1)
+            publisher.publish(1, 'change', dict(deleted=[1]))
+            self.assertEqual(subscription.get(1), ('change', dict(deleted=[1])))
+            self.assertNotIn('stale.sock', os.listdir(directory))
+        finally:
+            publisher.transport.close()
+            receiver.transport.close()
+            shutil.rmtree(directory)
+
+    def test_socket_transport_stalled_peer(self):
+        directory = tempfile.mkdtemp()
+        transport = SocketTransport(directory)
+        # 绑定了套接字但不再读取的进程
+        stalled = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stalled.bind(os.path.join(directory, 'stalled.sock'))
+        try:
+            thread = threading.Thread(target=lambda: [transport.send(1, 'change', dict(deleted=[i]))
+                                                      for i in range(1000)], daemon=True)
+            thread.start()
+            thread.join(5)
+            self.assertFalse(thread.is_alive())
+        finally:
+            stalled.close()
+            shutil.rmtree(directory)
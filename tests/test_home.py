@@ -1,5 +1,7 @@
 from flask import url_for
+from sqlalchemy import event
 
+from todoism.extensions import db, user_cache
 from .base import BaseTestCase
 
 
@@ -22,3 +24,31 @@ class HomeTestCase(BaseTestCase):
         self.client.get(url_for('home.set_locale', locale='zh'))
         response = self.client.get(url_for('home.intro'))
         self.assertIn('我们是有规划的人', response.get_data(as_text=True))
+
+    def test_set_locale_with_cached_user(self):
+        self.login()
+        self.client.get(url_for('home.intro'))
+        self.assertIsNotNone(user_cache.get(1))
+        self.client.get(url_for('home.set_locale', locale='en'))
+        self.assertIsNone(user_cache.get(1))
+        response = self.client.get(url_for('home.intro'))
+        self.assertIn('We are todoist, we use todoism', response.get_data(as_text=True))
+        self.assertEqual(user_cache.get(1), dict(id=1, username='test_user', locale='en'))
+
+    def test_cached_user_without_query(self):
+        self.login()
+        self.client.get(url_for('home.intro'))
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record)
+        try:
+            self.client.get(url_for('home.intro'))
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record)
+        # 缓存命中时不再加载用户, 只读取导航栏中的未完成计数
+        statements = [statement for statement in statements if 'FROM user' in statement]
+        self.assertEqual(len(statements), 1)
+        self.assertTrue(statements[0].startswith('SELECT user.active_count AS user_active_count \nFROM user'))
@@ -0,0 +1,70 @@
+import logging
+import time
+from unittest import mock
+
+from flask import url_for
+
+from todoism.log import RequestQueueHandler, ThrottledSMTPHandler
+from .base import BaseTestCase
+
+
+class SlowHandler(logging.Handler):
+    def __init__(self):
+        super(SlowHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        time.sleep(0.2)
+        self.records.append(self.format(record))
+
+
+class LogTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        super(LogTestCase, self).setUp()
+        self.logger = logging.getLogger('todoism.test_log')
+        self.logger.propagate = False
+
+    def tearDown(self) -> None:
+        for handler in list(self.logger.handlers):
+            self.logger.removeHandler(handler)
+            handler.close()
+        super(LogTestCase, self).tearDown()
+
+    def test_queue_handler(self):
+        slow = SlowHandler()
+        slow.setFormatter(logging.Formatter('%(url)s %(message)s'))
+        handler = RequestQueueHandler(10)
+        handler.listen(slow)
+        self.logger.addHandler(handler)
+        start = time.time()
+        self.logger.error('error %d', 1)
+        self.logger.error('error %d', 2)
+        self.assertLess(time.time() - start, 0.2)
+        handler.close()
+        self.assertEqual(slow.records, ['%s error 1' % url_for('home.index', _external=True), '%s error 2' % (
+            url_for('home.index', _external=True))])
+
+    def test_queue_full(self):
+        handler = RequestQueueHandler(2)
+        self.logger.addHandler(handler)
+        for i in range(5):
+            self.logger.error('error %d', i)
+        self.assertEqual(handler.dropped, 3)
+
+    def test_throttled_mail(self):
+        handler = ThrottledSMTPHandler(('localhost', 1025), 'todoism@localhost', ['admin@localhost'], 'Error',
+                                       interval=60)
+        self.logger.addHandler(handler)
+
+        def fail():
+            self.logger.error('same error')
+
+        with mock.patch('smtplib.SMTP') as smtp:
+            for _ in range(3):
+                fail()
+            self.logger.error('other error')
+            self.assertEqual(smtp.return_value.send_message.call_count, 2)
+            handler.interval = 0
+            fail()
+            message = smtp.return_value.send_message.call_args[0][0]
+            self.assertEqual(message['Subject'], 'Error (+2)')
@@ -0,0 +1,60 @@
+from flask import url_for, current_app
+
+from todoism.extensions import metrics
+from .base import BaseTestCase
+
+
+class MetricsTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        super(MetricsTestCase, self).setUp()
+        current_app.config['TODOISM_METRICS'] = True
+        current_app.config['TODOISM_METRICS_ALLOWED_IPS'] = ['127.0.0.1']
+        metrics.init_app(current_app)
+
+    def tearDown(self) -> None:
+        # 测试共享同一个程序, 其他测试不应带着统计钩子运行
+        metrics.remove_app(current_app)
+        super(MetricsTestCase, self).tearDown()
+
+    def test_metrics(self):
+        self.login()
+        self.client.get(url_for('todo.app'))
+        token = self.get_oauth_token()
+        self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token))
+        data = self.client.get(url_for('metrics')).get_data(as_text=True)
+        self.assertIn('todoism_request_duration_seconds_bucket{endpoint="todo.app",le="+Inf"} 1', data)
+        self.assertIn('todoism_request_duration_seconds_count{endpoint="api_v1.items"} 1', data)
+        self.assertIn('todoism_sql_statements_total{endpoint="todo.app"}', data)
+        self.assertNotIn('todoism_template_seconds_total{endpoint="todo.app"} 0\n', data)
+        self.assertNotIn('todoism_serialization_seconds_total{endpoint="api_v1.items"} 0\n', data)
+        self.assertIn('todoism_n_plus_one_total{endpoint="api_v1.items"} 0', data)
+        self.assertIn('todoism_cache_requests_total{cache="token",result="hit"}', data)
+
+    def test_n_plus_one(self):
+        # 阈值为0时每条执行过的SQL都按N+1查询记录, 不需要为测试注册新的路由
+        metrics.threshold = 0
+        token = self.get_oauth_token()
+        with self.assertLogs(current_app.logger, 'WARNING') as logs:
+            self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token))
+        self.assertIn('N+1 query in api_v1.items', logs.output[0])
+        data = self.client.get(url_for('metrics')).get_data(as_text=True)
+        self.assertRegex(data, r'todoism_n_plus_one_total\{endpoint="api_v1.items"\} [1-9]')
+
+    def test_metrics_access(self):
+        current_app.config['TODOISM_METRICS_ALLOWED_IPS'] = []
+        self.assertEqual(self.client.get(url_for('metrics')).status_code, 403)
+        current_app.config['TODOISM_METRICS_TOKEN'] = 'metrics-token'
+        response = self.client.get(url_for('metrics'), headers={'Authorization': 'Bearer wrong'})
+        self.assertEqual(response.status_code, 403)
+        response = self.client.get(url_for('metrics'), headers={'Authorization': 'Bearer metrics-token'})
+        self.assertEqual(response.status_code, 200)
+        current_app.config['TODOISM_METRICS_ALLOWED_IPS'] = ['10.0.0.1']
+        response = self.client.get(url_for('metrics'), environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_remove_app(self):
+        metrics.remove_app(current_app)
+        self.assertNotIn(metrics.start_request, current_app.before_request_funcs.get(None, ()))
+        self.assertEqual(self.client.get(url_for('metrics')).status_code, 404)
+        self.client.get(url_for('home.index'))
+        self.assertEqual(metrics.latency, {})
@@ -0,0 +1,62 @@
+from flask import url_for, current_app
+from sqlalchemy import event
+
+from todoism.extensions import db
+from todoism.modles import User, Item
+from .base import BaseTestCase
+
+
+class QueryPlanTestCase(BaseTestCase):
+    """对接口实际执行的查询运行EXPLAIN QUERY PLAN, 出现全表扫描或临时排序时失败"""
+
+    def setUp(self) -> None:
+        super(QueryPlanTestCase, self).setUp()
+        user = User.query.get(1)
+        db.session.add_all([Item(body='Item %d' % i, done=i % 2 == 0, author=user) for i in range(4)])
+        db.session.commit()
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.record)
+
+    def tearDown(self) -> None:
+        event.remove(db.engine, 'before_cursor_execute', self.record)
+        super(QueryPlanTestCase, self).tearDown()
+
+    def record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT') and 'item' in statement:
+            self.statements.append((statement, parameters))
+
+    def assertIndexedPlans(self):
+        self.assertTrue(self.statements)
+        for statement, parameters in self.statements:
+            cursor = db.session.connection().connection.cursor()
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            for detail in [row[-1] for row in cursor.fetchall()]:
+                scan = detail.startswith('SCAN') and 'INDEX' not in detail and 'CONSTANT ROW' not in detail
+                self.assertFalse(scan or 'TEMP B-TREE' in detail, '%s\n%s' % (detail, statement))
+
+    def test_api_query_plans(self):
+        token = self.get_oauth_token()
+        headers = self.set_auth_header(token)
+        for end_point in ('api_v1.items', 'api_v1.active_items', 'api_v1.complete_items'):
+            self.client.get(url_for(end_point, page=2), headers=headers)
+            data = self.client.get(url_for(end_point, cursor='', with_count=1, per_page=1), headers=headers).get_json()
+            self.client.get(url_for(end_point, cursor=data['next'].split('cursor=')[1].split('&')[0]),
+                            headers=headers)
+        data = self.client.get(url_for('api_v1.item_changes'), headers=headers).get_json()
+        self.client.get(url_for('api_v1.item_changes', since=data['since']), headers=headers)
+        self.client.get(url_for('api_v1.export_items'), headers=headers)
+        self.client.get(url_for('api_v1.search_items', q='Item'), headers=headers)
+        self.client.get(url_for('api_v1.item', item_id=1), headers=headers)
+        self.assertIndexedPlans()
+
+    def test_app_query_plans(self):
+        self.login()
+        self.client.get(url_for('todo.app'))
+        for item_filter in ('all', 'active', 'completed'):
+            data = self.client.get(url_for('todo.items', filter=item_filter)).get_json()
+            self.assertIsNone(data['next'])
+        current_app.config['TODOISM_APP_ITEMS_PER_PAGE'] = 1
+        self.client.get(self.client.get(url_for('todo.items')).get_json()['next'])
+        self.client.patch(url_for('todo.toggle_item', item_id=1))
+        self.client.delete(url_for('todo.clear_items'))
+        self.assertIndexedPlans()
@@ -0,0 +1,80 @@
+import os
+import tempfile
+
+from flask import current_app, url_for
+
+from todoism.extensions import db, primary_pins, pin_serializer, PRIMARY_PIN_COOKIE
+from todoism.modles import Item
+from .base import BaseTestCase
+
+
+class ReplicaTestCase(BaseTestCase):
+    def setUp(self) -> None:
+        super(ReplicaTestCase, self).setUp()
+        fd, self.replica_path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        current_app.config['SQLALCHEMY_BINDS'] = {'replica': 'sqlite:///' + self.replica_path}
+        current_app.config['TODOISM_READ_REPLICAS'] = ['replica']
+        # 用另一个SQLite文件代替只读副本, 写入不同的数据以区分读取的数据库
+        replica = db.get_engine(current_app, bind='replica')
+        db.metadata.create_all(replica)
+        replica.execute("INSERT INTO user (id, username, all_count, active_count, item_version) "
+                        "VALUES (1, 'test_user', 1, 1, 0)")
+        replica.execute("INSERT INTO item (id, body, done, author_id) VALUES (1, 'Replica Item', 0, 1)")
+
+    def tearDown(self) -> None:
+        db.get_engine(current_app, bind='replica').dispose()
+        os.remove(self.replica_path)
+        super(ReplicaTestCase, self).tearDown()
+
+    def test_api_reads_from_replica(self):
+        token = self.get_oauth_token()
+        db.session.expunge_all()
+        response = self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token))
+        self.assertEqual(response.get_json()['items'][0]['body'], 'Replica Item')
+        # ETag使用副本上的条目版本, 不会用主库较新的版本标记副本上较旧的数据
+        self.assertEqual(response.headers['ETag'], 'W/"1-0-1"')
+        headers = self.set_auth_header(token)
+        headers['If-None-Match'] = response.headers['ETag']
+        db.session.expunge_all()
+        self.assertEqual(self.client.get(url_for('api_v1.items'), headers=headers).status_code, 200)
+
+        response = self.client.post(url_for('api_v1.items'), json={'body': 'Primary Item'},
+                                    headers=self.set_auth_header(token))
+        self.assertIsNotNone(primary_pins.get(1))
+        self.assertIn(PRIMARY_PIN_COOKIE, response.headers['Set-Cookie'])
+        db.session.expunge_all()
+        data = self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token)).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['Primary Item', 'Test Item'])
+
+        # 请求落在没有进程内固定记录的其他进程时, 根据cookie读取主库
+        primary_pins.delete(1)
+        db.session.expunge_all()
+        data = self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token)).get_json()
+        self.assertEqual([item['body'] for item in data['items']], ['Primary Item', 'Test Item'])
+
+        # 其他用户的cookie无效
+        self.client.set_cookie('todoism.site', PRIMARY_PIN_COOKIE, pin_serializer().dumps(2), domain='.todoism.site')
+        db.session.expunge_all()
+        data = self.client.get(url_for('api_v1.items'), headers=self.set_auth_header(token)).get_json()
+        self.assertEqual(data['items'][0]['body'], 'Replica Item')
+        self.assertEqual(Item.query.count(), 2)
+
+    def test_app_reads_from_replica(self):
+        self.login()
+        db.session.expunge_all()
+        response = self.client.get(url_for('todo.app'))
+        self.assertIn('Replica Item', response.get_data(as_text=True))
+        self.client.patch(url_for('todo.toggle_item', item_id=1))
+        db.session.expunge_all()
+        response = self.client.get(url_for('todo.app'))
+        self.assertIn('Test Item', response.get_data(as_text=True))
+
+    def test_no_pin_without_replicas(self):
+        current_app.config['TODOISM_READ_REPLICAS'] = []
+        token = self.get_oauth_token()
+        response = self.client.post(url_for('api_v1.items'), json={'body': 'New Item'},
+                                    headers=self.set_auth_header(token))
+        self.assertEqual(response.status_code, 201)
+        self.assertNotIn('Set-Cookie', response.headers)
+        self.assertIsNone(primary_pins.get(1))
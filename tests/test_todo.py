@@ -1,8 +1,12 @@
-from flask import url_for
+import contextlib
+import threading
 
-from todoism.extensions import db
-from todoism.modles import User, Item
-from .base import BaseTestCase
+from flask import url_for, current_app
+
+from todoism.batching import GroupCommit
+from todoism.extensions import db, group_commit, fragment_cache
+from todoism.modles import User, Item, ItemTombstone
+from .base import BaseTestCase, schema_isolation
 
 
 class TodoTestCase(BaseTestCase):
@@ -15,6 +19,60 @@ class TodoTestCase(BaseTestCase):
         self.assertIn('接下来计划干点啥', response.get_data(as_text=True))
         self.assertIn('清空', response.get_data(as_text=True))
 
+    def test_items_paging(self):
+        current_app.config['TODOISM_APP_ITEMS_PER_PAGE'] = 2
+        user = User.query.get(1)
+        db.session.add_all([Item(body='Paged Item %d' % i, done=i % 2 == 0, author=user) for i in range(3)])
+        db.session.commit()
+        data = self.client.get(url_for('todo.app')).get_data(as_text=True)
+        self.assertIn('Test Item', data)
+        self.assertIn('Paged Item 0', data)
+        self.assertNotIn('Paged Item 1', data)
+        self.assertIn('data-next="/items?filter=all', data)
+
+        data = self.client.get(url_for('todo.items')).get_json()
+        data = self.client.get(data['next']).get_json()
+        self.assertIn('Paged Item 1', data['html'])
+        self.assertIn('Paged Item 2', data['html'])
+        self.assertIsNone(data['next'])
+
+        data = self.client.get(url_for('todo.items', filter='completed')).get_json()
+        self.assertIn('Paged Item 0', data['html'])
+        self.assertIn('Paged Item 2', data['html'])
+        self.assertNotIn('Test Item', data['html'])
+        data = self.client.get(url_for('todo.items', filter='active')).get_json()
+        self.assertIn('Test Item', data['html'])
+        self.assertIn('Paged Item 1', data['html'])
+        self.assertIsNone(data['next'])
+
+        self.assertEqual(self.client.get(url_for('todo.items', filter='other')).status_code, 404)
+        self.assertEqual(self.client.get(url_for('todo.items', cursor='bad')).status_code, 400)
+
+    def test_item_fragment_cache(self):
+        self.client.get(url_for('todo.app'))
+        self.client.get(url_for('todo.app'))
+        self.assertEqual(fragment_cache.stats()['hits'], 1)
+        self.client.put(url_for('todo.edit_item', item_id=1), json=dict(body='Cached Item'))
+        data = self.client.get(url_for('todo.app')).get_data(as_text=True)
+        self.assertIn('Cached Item', data)
+        self.assertNotIn('Test Item', data)
+        self.client.patch(url_for('todo.toggle_item', item_id=1))
+        self.assertIn('check_box<', self.client.get(url_for('todo.app')).get_data(as_text=True))
+        self.client.get(url_for('home.set_locale', locale='en'))
+        self.client.get(url_for('todo.app'))
+        self.assertEqual(fragment_cache.stats()['size'], 2)
+
+    def test_search(self):
+        db.session.add(Item(body='Search me', author=User.query.get(1)))
+        db.session.commit()
+        data = self.client.get(url_for('todo.search', q='search')).get_json()
+        self.assertIn('Search me', data['html'])
+        self.assertNotIn('Test Item', data['html'])
+        self.assertEqual(self.client.get(url_for('todo.search')).status_code, 400)
+        for page in (0, -1):
+            data = self.client.get(url_for('todo.search', q='search', page=page)).get_json()
+            self.assertIn('Search me', data['html'])
+
     def test_new_item(self):
         response = self.client.post(url_for('todo.new_item'), json=dict(
             body='test new item'
@@ -57,6 +115,37 @@ class TodoTestCase(BaseTestCase):
         self.assertIn('权限错误', response.get_json().get('message'))
         self.assertEqual(response.status_code, 403)
 
+    @schema_isolation
+    def test_toggle_item_coalesced(self):
+        current_app.config['TODOISM_WRITE_COALESCING'] = True
+        response = self.client.patch(url_for('todo.toggle_item', item_id=1))
+        self.assertIn('更新成功', response.get_json().get('message'))
+        self.assertTrue(Item.query.get(1).done)
+        self.assertEqual(User.query.get(1).completed_count, 1)
+        self.assertEqual(group_commit.stats()['statements'], 1)
+        self.logout()
+        self.login('test_user2')
+        response = self.client.patch(url_for('todo.toggle_item', item_id=1))
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(Item.query.get(1).done)
+
+    def test_group_commit_stats(self):
+        class Engine(object):
+            @staticmethod
+            def begin():
+                return contextlib.nullcontext()
+
+        batcher = GroupCommit(window=0, max_size=1)
+        threads = [threading.Thread(target=lambda: [batcher.submit(Engine, lambda connection: None)
+                                                    for _ in range(200)]) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = batcher.stats()
+        self.assertEqual(stats['statements'], 1600)
+        self.assertLessEqual(stats['batches'], 1600)
+
     def test_delete_item(self):
         self.logout()
         self.login('test_user2')
@@ -67,8 +156,11 @@ class TodoTestCase(BaseTestCase):
         self.login()
         response = self.client.delete(url_for('todo.delete_item', item_id=1))
         self.assertIn('删除成功', response.get_json().get('message'))
+        db.session.rollback()
+        self.assertIsNone(Item.query.get(1))
 
     def test_clear_items(self):
+        current_app.config['TODOISM_CLEAR_CHUNK_SIZE'] = 2
         user = User.query.get(1)
         self.client.patch(url_for('todo.toggle_item', item_id=1))
         item = Item(body='test item 2', done=True, author=user)
@@ -76,4 +168,8 @@ class TodoTestCase(BaseTestCase):
         db.session.add_all([item, item1])
         response = self.client.delete(url_for('todo.clear_items'))
         self.assertIn('已清理完成条目', response.get_json().get('message'))
+        self.assertEqual(response.get_json().get('count'), 3)
+        self.assertEqual(ItemTombstone.query.count(), 3)
         self.assertEqual(Item.query.with_parent(user).filter_by(done=True).count(), 0)
+        self.assertEqual(user.all_count, 0)
+        self.assertEqual(user.active_count, 0)
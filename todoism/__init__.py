@@ -1,15 +1,32 @@
+import cProfile
+import io
+import json
 import logging
 import os
-from logging.handlers import RotatingFileHandler, SMTPHandler
+import pstats
+import shutil
+import time
+from collections import Counter
+from datetime import datetime, timedelta
+from logging.handlers import RotatingFileHandler
 
 import click
 from flask import Flask, request, render_template, jsonify
 from flask_login import current_user
+from sqlalchemy import event, inspect as sa_inspect
 
+from . import assets as asset_builder, bench, importer, seeding
 from .apis.v1 import api_v1
+from .apis.v1.auth import generate_token
 from .blueprints import auth_bp, home_bp, todo_bp
-from .extensions import db, login_manager, csrf, babel
-from .modles import User, Item
+from .extensions import db, login_manager, csrf, babel, token_cache, user_cache, primary_pins, \
+    group_commit, fragment_cache, metrics, hashing_pool, sqlite_pragmas, \
+    event_broker, compressor, assets, set_primary_pin_cookie
+from .modles import User, Item, ItemTombstone, RefreshToken, rebuild_item_counts
+from .log import RequestQueueHandler, ThrottledSMTPHandler
+from .search import rebuild_search_index
+from .events import EventStreamBusy
+from .security import HashingPoolBusy
 
 
 def create_app(config_name=None):
@@ -32,43 +49,75 @@ def create_app(config_name=None):
 
 def register_logging(app=None):
     app.logger.setLevel(logging.INFO)
-
-    formatter = logging.Formatter('%(asctime)s - %(levelname)s - "%(pathname)s", line:%(lineno)s - %(message)s')
-    file_handler = RotatingFileHandler('logs/data.log', maxBytes=10 * 1024 * 1024, backupCount=10)
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.INFO)
-
-    class RequestFormatter(logging.Formatter):
-        def format(self, record):
-            record.url = request.url
-            record.remote_addr = request.remote_addr
-            return super(RequestFormatter, self).format(record)
-
-    request_formatter = RequestFormatter(
-        '[%(asctime)s] - "%(remote_addr)s : %(url)s" - %(levelname)s - "%(pathname)s", line:%(lineno)s - %(message)s'
-    )
-
-    mail_handler = SMTPHandler(
-        mailhost=app.config['MAIL_SERVER'],
-        fromaddr=app.config['MAIL_USERNAME'],
-        toaddrs=app.config['ALBUMY_ADMIN_EMAIL'],
-        subject='Albumy程序错误',
-        credentials=(app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
-    )
-    mail_handler.setFormatter(request_formatter)
-    mail_handler.setLevel(logging.ERROR)
-
-    if not app.debug:
-        app.logger.addHandler(file_handler)
-        app.logger.addHandler(mail_handler)
+    # 多次创建程序(例如测试)时关闭之前的队列和后台线程
+    for handler in list(app.logger.handlers):
+        if isinstance(handler, RequestQueueHandler):
+            app.logger.removeHandler(handler)
+            handler.close()
+    if app.debug:
+        return
+
+    handlers = []
+    if app.config['TODOISM_LOG_FILE']:
+        formatter = logging.Formatter('%(asctime)s - %(levelname)s - "%(pathname)s", line:%(lineno)s - %(message)s')
+        file_handler = RotatingFileHandler(app.config['TODOISM_LOG_FILE'], maxBytes=10 * 1024 * 1024, backupCount=10)
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+    if app.config['MAIL_SERVER'] and app.config['TODOISM_ADMIN_EMAIL']:
+        # url和remote_addr由RequestQueueHandler在请求线程中记录
+        request_formatter = logging.Formatter(
+            '[%(asctime)s] - "%(remote_addr)s : %(url)s" - %(levelname)s - "%(pathname)s", line:%(lineno)s - '
+            '%(message)s'
+        )
+        credentials = None
+        if app.config['MAIL_USERNAME']:
+            credentials = (app.config['MAIL_USERNAME'], app.config['MAIL_PASSWORD'])
+        mail_handler = ThrottledSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr=app.config['MAIL_DEFAULT_SENDER'],
+            toaddrs=[app.config['TODOISM_ADMIN_EMAIL']],
+            subject='Todoism程序错误',
+            credentials=credentials,
+            secure=() if app.config['MAIL_USE_TLS'] else None,
+            timeout=app.config['MAIL_TIMEOUT'],
+            interval=app.config['TODOISM_ERROR_MAIL_INTERVAL']
+        )
+        mail_handler.setFormatter(request_formatter)
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+
+    if not handlers:
+        return
+    # 文件和邮件处理器在后台线程中执行, 请求线程只把记录放入有界队列
+    queue_handler = RequestQueueHandler(app.config['TODOISM_LOG_QUEUE_SIZE'])
+    queue_handler.listen(*handlers)
+    app.logger.addHandler(queue_handler)
 
 
 def register_extensions(app=None):
     db.init_app(app)
+    if app.config['TODOISM_SQLITE_PRAGMAS']:
+        with app.app_context():
+            if db.engine.dialect.name == 'sqlite':
+                event.listen(db.engine, 'connect', sqlite_pragmas(app.config['TODOISM_SQLITE_PRAGMAS']))
     login_manager.init_app(app)
     csrf.init_app(app)
     csrf.exempt(api_v1)
     babel.init_app(app)
+    token_cache.init_app(app, app.config['TODOISM_TOKEN_CACHE_SIZE'], app.config['TODOISM_TOKEN_CACHE_TIMEOUT'])
+    user_cache.init_app(app, app.config['TODOISM_USER_CACHE_SIZE'], app.config['TODOISM_USER_CACHE_TIMEOUT'])
+    primary_pins.init_app(app, app.config['TODOISM_USER_CACHE_SIZE'], app.config['TODOISM_REPLICA_PIN_SECONDS'])
+    app.after_request(set_primary_pin_cookie)
+    group_commit.init_app(app)
+    fragment_cache.init_app(app, app.config['TODOISM_FRAGMENT_CACHE_SIZE'],
+                            app.config['TODOISM_FRAGMENT_CACHE_TIMEOUT'])
+    metrics.init_app(app)
+    hashing_pool.init_app(app)
+    event_broker.init_app(app)
+    compressor.init_app(app)
+    assets.init_app(app)
 
 
 def register_blueprint(app=None):
@@ -88,11 +137,21 @@ def register_template_context(app=None):
     @app.context_processor
     def make_template_context():
         if current_user.is_authenticated:
-            active_items = Item.query.with_parent(current_user).filter_by(done=False).count()
+            user = current_user._get_current_object()
+            if 'active_count' in sa_inspect(user).unloaded:
+                # 从缓存还原的用户只读取计数这一列, 计数经常变化, 不放入缓存
+                active_items = db.session.query(User.active_count).filter(User.id == user.id).scalar()
+            else:
+                active_items = user.active_count
         else:
             active_items = None
         return dict(active_items=active_items)
 
+    if app.config['TODOISM_PRECOMPILE_TEMPLATES']:
+        # 启动时编译所有模板并放入Jinja的模板缓存, 避免第一次请求时编译
+        for name in app.jinja_env.list_templates(extensions=['html']):
+            app.jinja_env.get_template(name)
+
 
 def register_errors(app=None):
     @app.errorhandler(400)
@@ -131,6 +190,14 @@ def register_errors(app=None):
             return response
         return render_template('errors.html', code=500, info='系统错误'), 500
 
+    @app.errorhandler(HashingPoolBusy)
+    @app.errorhandler(EventStreamBusy)
+    def server_busy(e):
+        response = jsonify(code=503, message='服务器繁忙, 请稍后重试')
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+
 
 def register_commands(app=None):
     @app.cli.command()
@@ -145,6 +212,172 @@ def register_commands(app=None):
         db.create_all()
         click.echo('Done!')
 
+    @app.cli.command()
+    def rebuild_counts():
+        """重新统计所有用户的条目计数"""
+        click.echo('正在重新统计条目计数...')
+        rebuild_item_counts()
+        db.session.commit()
+        click.echo('Done!')
+
+    @app.cli.command()
+    def upgrade_db():
+        """升级已有的数据库: 添加缺少的表, 列和索引, 重建全文索引"""
+        click.echo('正在升级数据库...')
+        db.create_all()
+        inspector = sa_inspect(db.engine)
+        for table in db.metadata.sorted_tables:
+            columns = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in columns:
+                    continue
+                ddl = 'ALTER TABLE %s ADD COLUMN %s %s' % (table.name, column.name,
+                                                           column.type.compile(db.engine.dialect))
+                if column.server_default is not None:
+                    ddl += " NOT NULL DEFAULT '%s'" % column.server_default.arg
+                db.session.execute(ddl)
+                click.echo('添加列 %s.%s' % (table.name, column.name))
+            indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in indexes:
+                    index.create(db.session.connection())
+                    click.echo('添加索引 %s' % index.name)
+        Item.query.filter(Item.updated_at.is_(None)).update({Item.updated_at: Item.timestamp},
+                                                            synchronize_session=False)
+        rebuild_item_counts()
+        rebuild_search_index()
+        db.session.commit()
+        click.echo('Done!')
+
+    @app.cli.command()
+    @click.argument('path')
+    @click.option('--username', help='以该用户身份请求')
+    @click.option('--method', default='GET', help='请求方法')
+    @click.option('--count', default=20, help='请求次数')
+    @click.option('--sort', default='cumulative', help='结果的排序字段')
+    @click.option('--limit', default=30, help='显示的函数数量')
+    def profile(path, username, method, count, sort, limit):
+        """用cProfile分析请求某个路由的耗时, 以/v1/开头的路径请求API"""
+        client = app.test_client()
+        api = path.startswith('/v1/')
+        base_url = 'http://%s%s' % ('api.' if api else '', app.config['SERVER_NAME'])
+        headers = {}
+        if username is not None:
+            user = User.query.filter_by(username=username).first()
+            if user is None:
+                raise click.BadParameter('用户不存在', param_hint='--username')
+            if api:
+                headers['Authorization'] = 'Bearer ' + generate_token(user)[0]
+            else:
+                with client.session_transaction(base_url=base_url) as session:
+                    session['_user_id'] = str(user.id)
+                    session['_fresh'] = True
+        profiler = cProfile.Profile()
+        statuses = Counter()
+        for _ in range(count):
+            profiler.enable()
+            response = client.open(path, method=method, base_url=base_url, headers=headers)
+            profiler.disable()
+            statuses[response.status_code] += 1
+        click.echo('状态码: %s' % ', '.join('%d x %d' % item for item in sorted(statuses.items())))
+        output = io.StringIO()
+        pstats.Stats(profiler, stream=output).sort_stats(sort).print_stats(limit)
+        click.echo(output.getvalue())
+
+    @app.cli.command()
+    @click.option('--users', default=10, help='生成的用户数量')
+    @click.option('--items-per-user', default=100, help='每个用户的条目数量')
+    @click.option('--password', default='12345678', help='所有生成的用户使用的密码')
+    def seed(users, items_per_user, password):
+        """用Faker批量生成测试用户和条目(需要安装开发依赖)"""
+        try:
+            import faker  # noqa
+        except ImportError:
+            raise click.ClickException('需要安装faker: pipenv install --dev')
+        click.echo('正在生成数据...')
+        start = time.time()
+        usernames = seeding.seed(users, items_per_user, password)
+        click.echo('生成%d个用户, %d个条目, 用时%.2f秒' % (users, users * items_per_user, time.time() - start))
+        if usernames:
+            click.echo('示例用户: %s, 密码: %s' % (usernames[0], password))
+
+    @app.cli.command('bench')
+    @click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(bench.SCENARIOS),
+                  help='要运行的场景, 可以重复使用, 默认运行所有场景')
+    @click.option('--requests', default=200, type=click.IntRange(1), help='每个场景的请求数')
+    @click.option('--concurrency', default=4, type=click.IntRange(1), help='并发的用户数')
+    @click.option('--output', type=click.File('w'), help='把JSON结果写入文件')
+    def run_bench(scenarios, requests, concurrency, output):
+        """在进程内并发请求主要路由, 以JSON输出吞吐量, 延迟分位数和每个请求的SQL数量(会写入数据, 请使用测试数据库)"""
+        app.config['WTF_CSRF_ENABLED'] = False
+        try:
+            result = bench.run(app, scenarios or bench.SCENARIOS, requests, concurrency)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        text = json.dumps(result, indent=2)
+        click.echo(text)
+        if output is not None:
+            output.write(text + '\n')
+
+    @app.cli.command()
+    def prune_tokens():
+        """删除已过期或已撤销的刷新令牌"""
+        count = RefreshToken.query.filter(db.or_(RefreshToken.expires_at < datetime.utcnow(),
+                                                 RefreshToken.revoked_at.isnot(None))).delete(synchronize_session=False)
+        db.session.commit()
+        click.echo('删除了%d个令牌' % count)
+
+    @app.cli.command()
+    def prune_tombstones():
+        """删除超过保留期限的条目删除记录"""
+        expired = datetime.utcnow() - timedelta(days=app.config['TODOISM_TOMBSTONE_DAYS'])
+        count = ItemTombstone.query.filter(ItemTombstone.deleted_at < expired).delete()
+        db.session.commit()
+        click.echo('删除了%d条记录' % count)
+
+    @app.cli.command()
+    @click.argument('file', type=click.File('r', encoding='utf-8'))
+    @click.option('--username', required=True, help='导入到该用户')
+    @click.option('--format', 'import_format', type=click.Choice(['ndjson', 'csv']), default='ndjson', help='文件格式')
+    @click.option('--chunk-size', default=None, type=int, help='每个事务插入的条目数')
+    @click.option('--skip', default=0, help='跳过前几行, 用于失败后继续导入')
+    def import_items(file, username, import_format, chunk_size, skip):
+        """从NDJSON或CSV文件批量导入条目"""
+        user = User.query.filter_by(username=username).first()
+        if user is None:
+            raise click.BadParameter('用户不存在', param_hint='--username')
+        if chunk_size is None:
+            chunk_size = app.config['TODOISM_IMPORT_CHUNK_SIZE']
+        click.echo('正在导入条目...')
+        result = importer.import_items(user, importer.read_rows(file, import_format), chunk_size, skip)
+        click.echo('导入%(imported)d条, 用时%(seconds)s秒, 每秒%(rows_per_second)s条' % result)
+        if result['error'] is not None:
+            click.echo('导入失败: %s' % result['error'], err=True)
+            click.echo('使用 --skip %d 继续导入' % result['resume_from'], err=True)
+            raise SystemExit(1)
+        click.echo('Done!')
+
+    @app.cli.group('assets')
+    def assets_group():
+        """静态文件命令"""
+        pass
+
+    @assets_group.command()
+    def build():
+        """生成带内容哈希的静态文件和预先压缩的.gz/.br文件(需要安装brotli)"""
+        click.echo('正在构建静态文件...')
+        manifest = asset_builder.build(app.static_folder)
+        if asset_builder.brotli is None:
+            click.echo('未安装brotli, 只生成.gz文件')
+        click.echo('生成%d个文件' % len(manifest))
+        click.echo('Done!')
+
+    @assets_group.command()
+    def clean():
+        """删除构建的静态文件, 恢复使用原文件"""
+        shutil.rmtree(os.path.join(app.static_folder, 'dist'), ignore_errors=True)
+        click.echo('Done!')
+
     @app.cli.group()
     def translate():
         """翻译以及本地化命令"""
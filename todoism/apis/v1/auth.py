@@ -1,28 +1,57 @@
+import time
+from datetime import datetime
 from functools import wraps
 
 from flask import request, current_app, g
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer, BadSignature, SignatureExpired
 
-from todoism.modles import User
+from todoism.extensions import db, token_cache
+from todoism.modles import User, RefreshToken
 from .errors import api_abort, token_missing, invalid_token
 
 
 def generate_token(user):
-    expiration = 3600
+    expiration = current_app.config['TODOISM_ACCESS_TOKEN_EXPIRATION']
     s = Serializer(current_app.config['SECRET_KEY'], expires_in=expiration)
     token = s.dumps({'id': user.id}).decode('ascii')
     return token, expiration
 
 
+def generate_refresh_token(user):
+    return RefreshToken.issue(user, current_app.config['TODOISM_REFRESH_TOKEN_EXPIRATION'])
+
+
+def rotate_refresh_token(token):
+    """撤销使用过的刷新令牌并返回它的用户, 令牌无效时返回None.
+
+    已撤销的令牌再次被使用说明令牌可能已泄露, 此时撤销该用户的所有刷新令牌.
+    同一个令牌的并发请求中只有一个能撤销成功, 其余的按重复使用处理.
+    """
+    refresh_token = RefreshToken.find(token)
+    if refresh_token is None or refresh_token.expires_at < datetime.utcnow():
+        return None
+    if not RefreshToken.revoke(refresh_token.id):
+        RefreshToken.revoke_all(refresh_token.user_id)
+        db.session.commit()
+        return None
+    return refresh_token.user
+
+
 def validation_token(token):
+    cached = token_cache.get(token)
+    if cached is not None:
+        g.current_user = User.from_cache(cached)
+        return True
     s = Serializer(current_app.config['SECRET_KEY'])
     try:
-        data = s.loads(token)
+        data, header = s.loads(token, return_header=True)
     except (BadSignature, SignatureExpired):
         return False
     user = User.query.get(data['id'])
     if user is None:
         return False
+    timeout = min(token_cache.timeout, header['exp'] - time.time())
+    token_cache.set(token, user.to_cache(), timeout, tags=(user.cache_tag,))
     g.current_user = user
     return True
 
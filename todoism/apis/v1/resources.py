@@ -1,12 +1,48 @@
-from flask import jsonify, request, url_for, g, current_app
+import csv
+import io
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+
+from flask import jsonify, request, url_for, g, current_app, make_response, Response, stream_with_context
 from flask.views import MethodView
+from sqlalchemy import and_, or_, inspect
+from sqlalchemy.orm import joinedload
 
-from todoism.extensions import db
-from todoism.modles import Item, User
+from todoism.extensions import db, use_replica, read_primary, reads_replica, event_broker
+from todoism.importer import import_items, read_rows
+from todoism.modles import Item, User, ItemTombstone, RefreshToken, record_deletions, toggle_item_done, \
+    clear_completed_items, encode_cursor, parse_cursor, item_etag, pending_changes
+from todoism.search import search_items
 from . import api_v1
-from .auth import generate_token, auth_required
+from .auth import generate_token, generate_refresh_token, rotate_refresh_token, auth_required
 from .errors import ValidationError, api_abort
-from .schemas import item_schema, items_schema, user_schema
+from .schemas import item_schema, items_schema, user_schema, json_response, json_dumps, item_url_template
+
+
+def conditional(f):
+    """根据当前用户的条目版本生成弱ETag, If-None-Match匹配时直接返回304, 不再查询和序列化.
+
+    条目版本每次都从主库读取, 不使用可能过期的缓存; 从只读副本读取时, 返回的ETag使用读取数据之前该副本上的版本,
+    避免用较新的ETag标记副本上较旧的数据. 需要放在use_replica之后.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        with read_primary():
+            etag = item_etag(g.current_user.id)
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            if reads_replica():
+                etag = item_etag(g.current_user.id)
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        if etag is not None:
+            response.set_etag(etag, weak=True)
+        response.vary.add('Authorization')
+        return response
+
+    return decorated
 
 
 def get_item_body():
@@ -17,6 +53,73 @@ def get_item_body():
     return body
 
 
+def decode_cursor(cursor):
+    try:
+        return parse_cursor(cursor)
+    except ValueError:
+        raise ValidationError('无效的游标')
+
+
+def get_per_page():
+    """per_page参数, 限制在1到TODOISM_MAX_PER_PAGE之间"""
+    per_page = request.args.get('per_page', current_app.config['TODOISM_ITEMS_PER_PAGE'], int)
+    return max(1, min(per_page, current_app.config['TODOISM_MAX_PER_PAGE']))
+
+
+def paginate_items(query, end_point):
+    """分页获取条目, 传入cursor(或after)参数时使用游标分页"""
+    per_page = get_per_page()
+    query = query.options(joinedload(Item.author))
+    cursor = request.args.get('cursor', request.args.get('after'))
+    if cursor is None:
+        page = request.args.get('page', 1, int)
+        pagination = query.order_by(Item.timestamp.desc()).paginate(page, per_page)
+        current = url_for(end_point, page=page, per_page=per_page, _external=True)
+        prev = None
+        if pagination.has_prev:
+            prev = url_for(end_point, page=page - 1, per_page=per_page, _external=True)
+        next = None
+        if pagination.has_next:
+            next = url_for(end_point, page=page + 1, per_page=per_page, _external=True)
+        return items_schema(pagination.items, end_point, per_page, current, prev, next, pagination)
+
+    count = None
+    if request.args.get('with_count', 0, int):
+        count = query.order_by(None).count()
+    seek = query.order_by(Item.timestamp.desc(), Item.id.desc())
+    if cursor:
+        timestamp, item_id = decode_cursor(cursor)
+        seek = seek.filter(or_(Item.timestamp < timestamp, and_(Item.timestamp == timestamp, Item.id < item_id)))
+    items = seek.limit(per_page + 1).all()
+    current = url_for(end_point, cursor=cursor, per_page=per_page, _external=True)
+    next = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        cursor = encode_cursor(items[-1].timestamp, items[-1].id)
+        next = url_for(end_point, cursor=cursor, per_page=per_page, _external=True)
+    return items_schema(items, end_point, per_page, current, None, next, count=count)
+
+
+def export_ndjson(query):
+    item_url = item_url_template()
+    user_url = url_for('.user', _external=True)
+    for item in query:
+        yield json_dumps(item_schema(item, item_url, user_url)) + b'\n'
+
+
+def export_csv(query):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['id', 'body', 'done', 'timestamp'])
+    for index, item in enumerate(query, 1):
+        writer.writerow([item.id, item.body, int(item.done), item.timestamp.isoformat()])
+        if index % 100 == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
 class IndexAPI(MethodView):
     def get(self):
         """获取基本资源"""
@@ -25,40 +128,59 @@ class IndexAPI(MethodView):
             api_base_url=url_for('.index', _external=True),
             current_user_url=url_for('.user', _external=True),
             authentication_url=url_for('.token', _external=True),
-            item_url=url_for('.item', item_id=0, _external=True)[:-1] + '{item_id}',
+            item_url=item_url_template(),
             current_user_items_url=url_for('.items', _external=True),
             current_user_active_items_url=url_for('.active_items', _external=True),
-            current_user_completed_items_url=url_for('.active_items', _external=True)
+            current_user_completed_items_url=url_for('.active_items', _external=True),
+            current_user_events_url=url_for('.item_events', _external=True)
         )
 
 
 class AuthTokenAPI(MethodView):
     def post(self):
-        """获取验证token"""
+        """获取验证token, 使用密码或刷新令牌"""
         grant_type = request.form.get('grant_type')
-        username = request.form.get('username')
-        password = request.form.get('password')
-
-        if grant_type is None or grant_type != 'password':
-            return api_abort(400, 'The Grant type must be \'password\'.')
-        user = User.query.filter_by(username=username).first()
-        if user is None or not user.validate_password(password):
-            return api_abort(400, 'username or password was invalid')
+
+        if grant_type == 'password':
+            username = request.form.get('username')
+            password = request.form.get('password')
+            user = User.query.filter_by(username=username).first()
+            if user is None or not user.validate_password(password):
+                return api_abort(400, 'username or password was invalid')
+        elif grant_type == 'refresh_token':
+            user = rotate_refresh_token(request.form.get('refresh_token', ''))
+            if user is None:
+                return api_abort(400, 'The refresh token was invalid.')
+        else:
+            return api_abort(400, 'The Grant type must be \'password\' or \'refresh_token\'.')
         token, expiration = generate_token(user)
+        refresh_token = generate_refresh_token(user)
+        db.session.commit()
 
         response = jsonify({
             'access_token': token,
             'token_type': 'Bearer',
-            'expires_in': expiration
+            'expires_in': expiration,
+            'refresh_token': refresh_token
         })
         response.headers['Cache-Control'] = 'no-store'
         response.headers['Pragma'] = 'no-cache'
         return response
 
 
+class RevokeTokenAPI(MethodView):
+    def post(self):
+        """撤销刷新令牌, 令牌无效时也返回200"""
+        refresh_token = RefreshToken.find(request.form.get('token', ''))
+        if refresh_token is not None and RefreshToken.revoke(refresh_token.id):
+            db.session.commit()
+        return '', 200
+
+
 class UserAPI(MethodView):
     decorators = [auth_required]
 
+    @conditional
     def get(self):
         return jsonify(user_schema(g.current_user))
 
@@ -66,12 +188,20 @@ class UserAPI(MethodView):
 class ItemAPI(MethodView):
     decorators = [auth_required]
 
+    @use_replica
     def get(self, item_id):
-        """获取条目"""
+        """获取条目, 先检查条目是否存在和所有者, 再用条目的修改时间生成弱ETag"""
         item = Item.query.get_or_404(item_id)
         if g.current_user != item.author:
             return api_abort(403)
-        return jsonify(item_schema(item))
+        etag = '%d-%s' % (item.id, item.updated_at.isoformat() if item.updated_at else '')
+        if request.if_none_match.contains_weak(etag):
+            response = current_app.response_class(status=304)
+        else:
+            response = jsonify(item_schema(item))
+        response.set_etag(etag, weak=True)
+        response.vary.add('Authorization')
+        return response
 
     def put(self, item_id):
         """修改条目"""
@@ -84,6 +214,11 @@ class ItemAPI(MethodView):
 
     def patch(self, item_id):
         """切换完成状态"""
+        if current_app.config['TODOISM_WRITE_COALESCING']:
+            if toggle_item_done(item_id, g.current_user.id):
+                return '', 204
+            Item.query.get_or_404(item_id)
+            return api_abort(403)
         item = Item.query.get_or_404(item_id)
         if g.current_user != item.author:
             return api_abort(403)
@@ -104,20 +239,11 @@ class ItemAPI(MethodView):
 class ItemsAPI(MethodView):
     decorators = [auth_required]
 
+    @use_replica
+    @conditional
     def get(self):
         """获取所有条目"""
-        page = request.args.get('page', 1, int)
-        per_page = request.args.get('per_page', current_app.config['TODOISM_ITEMS_PER_PAGE'], int)
-        pagination = Item.query.with_parent(g.current_user).order_by(Item.timestamp.desc()).paginate(page, per_page)
-        items = pagination.items
-        current = url_for('.items', page=page, per_page=per_page, _external=True)
-        prev = None
-        if pagination.has_prev:
-            prev = url_for('.items', page=page - 1, per_page=per_page, _external=True)
-        next = None
-        if pagination.has_next:
-            next = url_for('.items', page=page + 1, per_page=per_page, _external=True)
-        return jsonify(items_schema(items, '.items', per_page, current, prev, next, pagination))
+        return json_response(paginate_items(Item.query.with_parent(g.current_user), '.items'))
 
     def post(self):
         """创建新条目"""
@@ -133,53 +259,274 @@ class ItemsAPI(MethodView):
 class ActiveItemsAPI(MethodView):
     decorators = [auth_required]
 
+    @use_replica
+    @conditional
     def get(self):
         """获取所有未完成的条目"""
-        page = request.args.get('page', 1, int)
-        per_page = request.args.get('per_page', current_app.config['TODOISM_ITEMS_PER_PAGE'], int)
-        pagination = Item.query.with_parent(g.current_user).filter_by(done=False).order_by(
-            Item.timestamp.desc()).paginate(page, per_page)
-        items = pagination.items
-        current = url_for('.active_items', page=page, per_page=per_page, _external=True)
-        prev = None
-        if pagination.has_prev:
-            prev = url_for('.active_items', page=page - 1, per_page=per_page, _external=True)
-        next = None
-        if pagination.has_next:
-            next = url_for('.active_items', page=page + 1, per_page=per_page, _external=True)
-        return jsonify(items_schema(items, '.active_items', per_page, current, prev, next, pagination))
+        query = Item.query.with_parent(g.current_user).filter_by(done=False)
+        return json_response(paginate_items(query, '.active_items'))
 
 
 class CompletedItemAPI(MethodView):
     decorators = [auth_required]
 
+    @use_replica
+    @conditional
     def get(self):
         """获取所有已完成的条目"""
+        query = Item.query.with_parent(g.current_user).filter_by(done=True)
+        return json_response(paginate_items(query, '.complete_items'))
+
+    def delete(self):
+        """删除所有完成条目"""
+        clear_completed_items(g.current_user, current_app.config['TODOISM_CLEAR_CHUNK_SIZE'])
+        return '', 204
+
+
+class SearchItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    @use_replica
+    @conditional
+    def get(self):
+        """全文搜索条目, 结果按相关度排序并分页"""
+        keywords = request.args.get('q', '').strip()
+        if not keywords:
+            raise ValidationError('搜索关键词为空')
         page = request.args.get('page', 1, int)
-        per_page = request.args.get('per_page', current_app.config['TODOISM_ITEMS_PER_PAGE'], int)
-        pagination = Item.query.with_parent(g.current_user).filter_by(done=True).order_by(
-            Item.timestamp.desc()).paginate(page, per_page)
-        items = pagination.items
-        current = url_for('.complete_items', page=page, per_page=per_page, _external=True)
+        per_page = get_per_page()
+        query = search_items(Item.query.with_parent(g.current_user).options(joinedload(Item.author)), keywords)
+        pagination = query.paginate(page, per_page)
+        current = url_for('.search_items', q=keywords, page=page, per_page=per_page, _external=True)
         prev = None
         if pagination.has_prev:
-            prev = url_for('.complete_items', page=page - 1, per_page=per_page, _external=True)
+            prev = url_for('.search_items', q=keywords, page=page - 1, per_page=per_page, _external=True)
         next = None
         if pagination.has_next:
-            next = url_for('.complete_items', page=page + 1, per_page=per_page, _external=True)
-        return jsonify(items_schema(items, '.complete_items', per_page, current, prev, next, pagination))
+            next = url_for('.search_items', q=keywords, page=page + 1, per_page=per_page, _external=True)
+        return json_response(items_schema(pagination.items, '.search_items', per_page, current, prev, next,
+                                          pagination, q=keywords))
 
-    def delete(self):
-        """删除所有完成条目"""
-        Item.query.with_parent(g.current_user).filter_by(done=True).delete()
+
+class ItemChangesAPI(MethodView):
+    decorators = [auth_required]
+
+    @use_replica
+    def get(self):
+        """增量同步: 返回since之后修改过的条目和删除的条目ID, 客户端应先处理deleted再处理items.
+
+        修改和删除按时间合并排序, 一共最多返回limit条, 下一页从最后一条之后继续.
+        """
+        limit = max(1, min(request.args.get('limit', current_app.config['TODOISM_SYNC_LIMIT'], int),
+                           current_app.config['TODOISM_SYNC_LIMIT']))
+        since = request.args.get('since')
+        # 留出一段时间窗口, 避免漏掉并发事务中稍晚提交但时间戳较早的修改
+        synced_until = datetime.utcnow() - timedelta(seconds=current_app.config['TODOISM_SYNC_WINDOW'])
+        query = Item.query.with_parent(g.current_user).options(joinedload(Item.author)).order_by(
+            Item.updated_at, Item.id)
+        changes = []
+        if since:
+            since_at, since_id = decode_cursor(since)
+            retention = timedelta(days=current_app.config['TODOISM_TOMBSTONE_DAYS'])
+            if since_at < datetime.utcnow() - retention:
+                return api_abort(410, '同步标记已过期, 请重新完整同步')
+            query = query.filter(or_(Item.updated_at > since_at,
+                                     and_(Item.updated_at == since_at, Item.id > since_id)))
+            tombstones = db.session.query(ItemTombstone.deleted_at, ItemTombstone.item_id).filter(
+                ItemTombstone.author_id == g.current_user.id,
+                or_(ItemTombstone.deleted_at > since_at,
+                    and_(ItemTombstone.deleted_at == since_at, ItemTombstone.item_id > since_id))
+            ).order_by(ItemTombstone.deleted_at, ItemTombstone.item_id).limit(limit + 1)
+            changes = [(deleted_at, item_id, None) for deleted_at, item_id in tombstones]
+        changes.extend((item.updated_at, item.id, item) for item in query.limit(limit + 1))
+        changes.sort(key=lambda change: change[:2])
+        has_more = len(changes) > limit
+        if has_more:
+            changes = changes[:limit]
+            token = encode_cursor(changes[-1][0], changes[-1][1])
+        else:
+            token = encode_cursor(synced_until, 0)
+        items = [change[2] for change in changes if change[2] is not None]
+        deleted = [change[1] for change in changes if change[2] is None]
+
+        item_url = item_url_template()
+        user_url = url_for('.user', _external=True)
+        return json_response(dict(
+            kind='ItemChanges',
+            items=[item_schema(item, item_url, user_url) for item in items],
+            deleted=deleted,
+            since=token,
+            has_more=has_more,
+            next=url_for('.item_changes', since=token, limit=limit, _external=True)
+        ))
+
+
+class ItemEventsAPI(MethodView):
+    decorators = [auth_required]
+
+    def get(self):
+        """以Server-Sent Events推送当前用户条目的修改.
+
+        change事件包含新增和修改的条目, 删除的条目ID和计数的变化; 收到resync事件时应通过/user/items/changes重新同步.
+        """
+        subscription = event_broker.subscribe(g.current_user.id)
+        # 事件流会保持很久, 先归还数据库连接
+        db.session.remove()
+        return event_broker.response(subscription)
+
+
+class ExportItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    @use_replica
+    def get(self):
+        """以NDJSON或CSV格式流式导出所有条目"""
+        export_format = request.args.get('format', 'ndjson')
+        if export_format not in ('ndjson', 'csv'):
+            raise ValidationError('不支持的导出格式')
+        last_modified = max(filter(None, [
+            db.session.query(db.func.max(Item.updated_at)).filter(Item.author_id == g.current_user.id).scalar(),
+            db.session.query(db.func.max(ItemTombstone.deleted_at)).filter(
+                ItemTombstone.author_id == g.current_user.id).scalar()
+        ]), default=None)
+        if last_modified is not None:
+            last_modified = last_modified.replace(microsecond=0, tzinfo=timezone.utc)
+            if request.if_modified_since is not None and last_modified <= request.if_modified_since:
+                return '', 304
+
+        query = Item.query.with_parent(g.current_user).options(joinedload(Item.author)).order_by(
+            Item.timestamp, Item.id).yield_per(current_app.config['TODOISM_EXPORT_BATCH_SIZE'])
+        if export_format == 'csv':
+            response = Response(stream_with_context(export_csv(query)), mimetype='text/csv')
+            response.headers['Content-Disposition'] = 'attachment; filename=items.csv'
+        else:
+            response = Response(stream_with_context(export_ndjson(query)), mimetype='application/x-ndjson')
+        response.last_modified = last_modified
+        return response
+
+
+class ImportItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    def post(self):
+        """从请求体中的NDJSON或CSV批量导入条目"""
+        import_format = request.args.get('format')
+        if import_format is None:
+            import_format = 'csv' if request.mimetype == 'text/csv' else 'ndjson'
+        if import_format not in ('ndjson', 'csv'):
+            raise ValidationError('不支持的导入格式')
+        chunk_size = request.args.get('chunk_size', current_app.config['TODOISM_IMPORT_CHUNK_SIZE'], int)
+        skip = request.args.get('skip', 0, int)
+        lines = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+        result = import_items(g.current_user, read_rows(lines, import_format), chunk_size, skip)
+        if result['error'] is not None:
+            return api_abort(400, result.pop('error'), kind='ImportResult', **result)
+        return jsonify(kind='ImportResult', **result)
+
+
+class BatchItemsAPI(MethodView):
+    decorators = [auth_required]
+
+    def post(self):
+        """在一个事务中批量创建, 修改, 切换和删除条目"""
+        data = request.get_json()
+        operations = data.get('operations') if isinstance(data, dict) else None
+        if not isinstance(operations, list) or not operations:
+            raise ValidationError('操作列表为空')
+        if len(operations) > current_app.config['TODOISM_BATCH_LIMIT']:
+            raise ValidationError('操作数量超过限制')
+
+        ids = {op.get('id') for op in operations if isinstance(op, dict) and isinstance(op.get('id'), int)}
+        items = {}
+        if ids:
+            items = {item.id: item for item in Item.query.filter(Item.id.in_(ids))}
+
+        results = []
+        created = []
+        deleted = {}
+        for index, op in enumerate(operations):
+            action = op.get('op') if isinstance(op, dict) else None
+            result = dict(index=index, op=action)
+            results.append(result)
+            if action == 'create':
+                body = op.get('body')
+                if body is None or str(body).strip() == '':
+                    result.update(status=400, message='消息内容为空')
+                    continue
+                item = Item(body=body, author=g.current_user)
+                db.session.add(item)
+                created.append(item)
+                result.update(status=201, item=item)
+                continue
+            if action not in ('update', 'toggle', 'delete'):
+                result.update(status=400, message='不支持的操作')
+                continue
+            item = items.get(op.get('id'))
+            result['id'] = op.get('id')
+            if item is None:
+                result.update(status=404, message='条目不存在')
+                continue
+            if item.author_id != g.current_user.id:
+                result.update(status=403, message='权限错误')
+                continue
+            if action == 'update':
+                body = op.get('body')
+                if body is None or str(body).strip() == '':
+                    result.update(status=400, message='消息内容为空')
+                    continue
+                item.body = body
+                result.update(status=200, item=item)
+            elif action == 'toggle':
+                item.done = not item.done
+                result.update(status=200, item=item)
+            else:
+                del items[item.id]
+                deleted[item.id] = item
+                result.update(status=204)
+
+        # 待删除的条目不再发出UPDATE, 最后用一条DELETE语句删除
+        active_deleted = 0
+        for item in deleted.values():
+            if not inspect(item).committed_state.get('done', item.done):
+                active_deleted += 1
+            db.session.expunge(item)
+        db.session.flush()
+        if deleted:
+            query = Item.query.filter(Item.id.in_(deleted))
+            record_deletions(query)
+            query.delete(synchronize_session=False)
+            g.current_user.change_counts(-len(deleted), -active_deleted)
+            # 批量删除不会触发flush事件, 手动记录推送给事件流的修改
+            changes = pending_changes(db.session, g.current_user.id)
+            for item_id in deleted:
+                changes['created'].pop(item_id, None)
+                changes['updated'].pop(item_id, None)
+            changes['deleted'].update(deleted)
+            changes['counts'][0] -= len(deleted)
+            changes['counts'][1] -= active_deleted
+
+        item_url = item_url_template()
+        user_url = url_for('.user', _external=True)
+        for result in results:
+            item = result.pop('item', None)
+            if item is not None and item.id not in deleted:
+                result['id'] = item.id
+                result['item'] = item_schema(item, item_url, user_url)
         db.session.commit()
-        return '', 204
+        return jsonify(kind='BatchResult', results=results)
 
 
 api_v1.add_url_rule('/', view_func=IndexAPI.as_view('index'), methods=['GET'])
 api_v1.add_url_rule('/oauth/token', view_func=AuthTokenAPI.as_view('token'), methods=['POST'])
+api_v1.add_url_rule('/oauth/revoke', view_func=RevokeTokenAPI.as_view('revoke_token'), methods=['POST'])
 api_v1.add_url_rule('/user', view_func=UserAPI.as_view('user'))
 api_v1.add_url_rule('/user/items', view_func=ItemsAPI.as_view('items'))
+api_v1.add_url_rule('/user/items/batch', view_func=BatchItemsAPI.as_view('batch_items'), methods=['POST'])
+api_v1.add_url_rule('/user/items/export', view_func=ExportItemsAPI.as_view('export_items'), methods=['GET'])
+api_v1.add_url_rule('/user/items/import', view_func=ImportItemsAPI.as_view('import_items'), methods=['POST'])
+api_v1.add_url_rule('/user/items/search', view_func=SearchItemsAPI.as_view('search_items'), methods=['GET'])
+api_v1.add_url_rule('/user/items/changes', view_func=ItemChangesAPI.as_view('item_changes'), methods=['GET'])
+api_v1.add_url_rule('/user/events', view_func=ItemEventsAPI.as_view('item_events'), methods=['GET'])
 api_v1.add_url_rule('/user/items/<int:item_id>', view_func=ItemAPI.as_view('item'))
 api_v1.add_url_rule('/user/items/active', view_func=ActiveItemsAPI.as_view('active_items'))
 api_v1.add_url_rule('/user/items/complete', view_func=CompletedItemAPI.as_view('complete_items'))
@@ -1,18 +1,46 @@
-from flask import url_for
+import json
 
-from todoism.modles import Item
+from flask import url_for, current_app
 
+from todoism.extensions import metrics
 
-def item_schema(item):
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def json_dumps(data):
+    """序列化为UTF-8编码的JSON, 安装了orjson时使用orjson"""
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_response(data, status=200):
+    with metrics.timer('serialization'):
+        body = json_dumps(data)
+    return current_app.response_class(body, status=status, mimetype='application/json')
+
+
+def item_url_template():
+    return url_for('.item', item_id=0, _external=True)[:-1] + '{item_id}'
+
+
+def item_schema(item, item_url=None, user_url=None):
+    if item_url is None:
+        item_url = item_url_template()
+    if user_url is None:
+        user_url = url_for('.user', _external=True)
     return dict(
         id=item.id,
-        self=url_for('.item', item_id=item.id, _external=True),
+        self=item_url.format(item_id=item.id),
         kind='Item',
         body=item.body,
         done=item.done,
         author=dict(
             id=item.author_id,
-            url=url_for('.user', _external=True),
+            url=user_url,
             username=item.author.username,
             kind='User'
         )
@@ -28,20 +56,33 @@ def user_schema(user):
         all_items_url=url_for('.items', _external=True),
         active_items_url=url_for('.active_items', _external=True),
         completed_items_url=url_for('.complete_items', _external=True),
-        all_item_count=len(user.items),
-        active_item_count=Item.query.with_parent(user).filter_by(done=False).count(),
-        completed_item_count=Item.query.with_parent(user).filter_by(done=True).count()
+        all_item_count=user.all_count,
+        active_item_count=user.active_count,
+        completed_item_count=user.completed_count
     )
 
 
-def items_schema(items, end_point, per_page, current, prev, next, pagination):
+def items_schema(items, end_point, per_page, current, prev, next, pagination=None, count=None, **args):
+    """items应使用joinedload预先加载author, URL只生成一次, args为first和last链接额外的查询参数"""
+    item_url = item_url_template()
+    user_url = url_for('.user', _external=True)
+    if pagination is None:
+        # 游标分页: 不提供最后一页, 第一页为空游标
+        last = None
+        first = url_for(end_point, cursor='', per_page=per_page, _external=True, **args)
+    else:
+        last = url_for(end_point, page=pagination.pages, per_page=per_page, _external=True, **args)
+        first = url_for(end_point, page=1, per_page=per_page, _external=True, **args)
+        count = pagination.total
+    with metrics.timer('serialization'):
+        items = [item_schema(item, item_url, user_url) for item in items]
     return dict(
         self=current,
         kind='ItemCollection',
-        items=[item_schema(item) for item in items],
+        items=items,
         prev=prev,
         next=next,
-        last=url_for(end_point, page=pagination.pages, per_page=per_page, _external=True),
-        first=url_for(end_point, page=1, per_page=per_page, _external=True),
-        count=pagination.total
+        last=last,
+        first=first,
+        count=count
     )
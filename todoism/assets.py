@@ -0,0 +1,151 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import current_app, request, send_from_directory
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+# 可以压缩的文本类型, 图片等已压缩的文件不再压缩
+COMPRESSIBLE_MIMETYPES = {'text/html', 'text/css', 'text/javascript', 'text/plain', 'text/csv', 'text/xml',
+                          'application/json', 'application/javascript', 'application/xml', 'application/x-ndjson',
+                          'image/svg+xml', 'image/x-icon', 'image/vnd.microsoft.icon'}
+ENCODING_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+def encodings():
+    """服务器支持的压缩方式, 按优先级排列, 安装了brotli时优先使用br"""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def compress(data, encoding, level):
+    if encoding == 'br':
+        return brotli.compress(data, quality=level)
+    # mtime固定为0, 相同的内容生成相同的压缩结果
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+class Compressor(object):
+    """根据Accept-Encoding压缩超过TODOISM_COMPRESS_MIN_SIZE字节的文本响应.
+
+    流式响应(例如事件流和导出)和直接发送的文件不压缩, 指纹化的静态文件在构建时已预先压缩.
+    """
+
+    def init_app(self, app):
+        if app.config['TODOISM_COMPRESS']:
+            app.after_request(self.compress_response)
+        app.extensions['compressor'] = self
+
+    @staticmethod
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE_MIMETYPES or response.direct_passthrough or response.is_streamed:
+            return response
+        response.vary.add('Accept-Encoding')
+        if not 200 <= response.status_code < 300 or response.status_code in (204, 206) \
+                or 'Content-Encoding' in response.headers \
+                or (response.content_length or 0) < current_app.config['TODOISM_COMPRESS_MIN_SIZE']:
+            return response
+        encoding = request.accept_encodings.best_match(encodings())
+        if encoding is None:
+            return response
+        level = current_app.config['TODOISM_BROTLI_QUALITY' if encoding == 'br' else 'TODOISM_GZIP_LEVEL']
+        response.set_data(compress(response.get_data(), encoding, level))
+        response.headers['Content-Encoding'] = encoding
+        # 压缩后的内容与原内容不再逐字节相同, 强ETag改为弱ETag
+        etag, weak = response.get_etag()
+        if etag is not None and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+
+def build(static_folder, output='dist', hash_length=12):
+    """把static_folder中的文件复制到output目录, 文件名加上内容哈希, 文本文件同时生成.gz和.br(需要brotli).
+
+    在output目录中写入manifest.json, 记录原文件名到带哈希文件名的映射, 返回该映射.
+    """
+    target = os.path.join(static_folder, output)
+    shutil.rmtree(target, ignore_errors=True)
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        if root == static_folder and output in dirs:
+            dirs.remove(output)
+        dirs.sort()
+        for name in sorted(files):
+            relative = os.path.relpath(os.path.join(root, name), static_folder).replace(os.sep, '/')
+            with open(os.path.join(root, name), 'rb') as f:
+                data = f.read()
+            base, ext = os.path.splitext(relative)
+            hashed = '%s/%s.%s%s' % (output, base, hashlib.sha256(data).hexdigest()[:hash_length], ext)
+            path = os.path.join(static_folder, *hashed.split('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            if mimetypes.guess_type(name)[0] in COMPRESSIBLE_MIMETYPES:
+                for encoding in encodings():
+                    compressed = compress(data, encoding, 11 if encoding == 'br' else 9)
+                    # 压缩后没有变小的文件直接发送原文件
+                    if len(compressed) < len(data):
+                        with open(path + ENCODING_SUFFIXES[encoding], 'wb') as f:
+                            f.write(compressed)
+            manifest[relative] = hashed
+    with open(os.path.join(target, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class Assets(object):
+    """使用flask assets build生成的指纹化静态文件.
+
+    存在TODOISM_ASSET_MANIFEST时, url_for('static', filename=...)生成带哈希的文件名, 这些文件的内容不会改变,
+    以immutable和TODOISM_ASSET_MAX_AGE缓存, 并按Accept-Encoding发送预先压缩的版本.
+    源文件修改后需要重新构建, 开发环境默认不使用清单.
+    """
+
+    def __init__(self):
+        self.manifest = {}
+        self._encodings = {}
+
+    def init_app(self, app):
+        self.load(app.config['TODOISM_ASSET_MANIFEST'], app.static_folder)
+        app.url_defaults(self.hashed_url)
+        app.view_functions['static'] = self.send_static_file
+        app.extensions['assets'] = self
+
+    def load(self, path, static_folder):
+        """读取清单并记录每个文件已有的预压缩版本, 清单不存在时使用原文件"""
+        self.manifest = {}
+        self._encodings = {}
+        if not path or not os.path.exists(path):
+            return
+        with open(path) as f:
+            self.manifest = json.load(f)
+        for hashed in self.manifest.values():
+            path = os.path.join(static_folder, *hashed.split('/'))
+            self._encodings[hashed] = [encoding for encoding in encodings()
+                                       if os.path.exists(path + ENCODING_SUFFIXES[encoding])]
+
+    def hashed_url(self, endpoint, values):
+        if endpoint == 'static' and values.get('filename') in self.manifest:
+            values['filename'] = self.manifest[values['filename']]
+
+    def send_static_file(self, filename):
+        if filename not in self._encodings:
+            return current_app.send_static_file(filename)
+        encoding = request.accept_encodings.best_match(self._encodings[filename])
+        response = send_from_directory(current_app.static_folder,
+                                       filename + ENCODING_SUFFIXES[encoding] if encoding else filename,
+                                       mimetype=mimetypes.guess_type(filename)[0],
+                                       max_age=current_app.config['TODOISM_ASSET_MAX_AGE'])
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+        if self._encodings[filename]:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
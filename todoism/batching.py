@@ -0,0 +1,80 @@
+import threading
+
+
+class _Job(object):
+    def __init__(self, statement):
+        self.statement = statement
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommit(object):
+    """把多个线程在很短的时间窗口内提交的小写操作合并到同一个事务中提交.
+
+    第一个到达的线程成为leader, 等待 TODOISM_GROUP_COMMIT_WINDOW 秒(或凑满 TODOISM_GROUP_COMMIT_SIZE 个操作)后
+    在一个事务中执行所有操作并只提交一次, 其余线程等待结果. 合并的事务失败时逐个重新执行, 只有出错的操作收到异常.
+    """
+
+    def __init__(self, window=0.005, max_size=64):
+        self.window = window
+        self.max_size = max_size
+        self.batches = 0
+        self.statements = 0
+        self._pending = []
+        self._leading = False
+        self._condition = threading.Condition()
+
+    def init_app(self, app):
+        self.window = app.config['TODOISM_GROUP_COMMIT_WINDOW']
+        self.max_size = app.config['TODOISM_GROUP_COMMIT_SIZE']
+        self.batches = self.statements = 0
+        app.extensions['group_commit'] = self
+
+    def submit(self, engine, statement):
+        """在合并的事务中执行statement(connection), 提交后返回它的结果"""
+        job = _Job(statement)
+        with self._condition:
+            self._pending.append(job)
+            leader = not self._leading
+            if leader:
+                self._leading = True
+            elif len(self._pending) >= self.max_size:
+                self._condition.notify_all()
+        if leader:
+            with self._condition:
+                if self.window > 0 and len(self._pending) < self.max_size:
+                    self._condition.wait(self.window)
+                jobs, self._pending = self._pending, []
+                self._leading = False
+            self._run(engine, jobs)
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self, engine, jobs):
+        batches = 1
+        try:
+            with engine.begin() as connection:
+                for job in jobs:
+                    job.result = job.statement(connection)
+        except Exception:
+            batches = len(jobs)
+            for job in jobs:
+                try:
+                    with engine.begin() as connection:
+                        job.result = job.statement(connection)
+                except Exception as e:
+                    job.error = e
+        finally:
+            # 多个leader可能同时执行, 计数在锁中更新
+            with self._condition:
+                self.batches += batches
+                self.statements += len(jobs)
+            for job in jobs:
+                job.done.set()
+
+    def stats(self):
+        with self._condition:
+            return dict(batches=self.batches, statements=self.statements)
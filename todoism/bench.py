@@ -0,0 +1,103 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from .apis.v1.auth import generate_token
+from .modles import User, Item
+
+SCENARIOS = ('app', 'new_item', 'toggle_item', 'api_items', 'api_item')
+
+
+class Client(object):
+    """一个模拟用户: 独立的测试客户端, 已登录的会话和API令牌"""
+
+    def __init__(self, app, user_id, item_id):
+        self.client = app.test_client()
+        self.item_id = item_id
+        self.web_url = 'http://%s' % app.config['SERVER_NAME']
+        self.api_url = 'http://api.%s' % app.config['SERVER_NAME']
+        self.headers = {'Authorization': 'Bearer ' + generate_token(User.query.get(user_id))[0]}
+        with self.client.session_transaction(base_url=self.web_url) as session:
+            session['_user_id'] = str(user_id)
+            session['_fresh'] = True
+
+    def request(self, scenario):
+        if scenario == 'app':
+            return self.client.get('/app', base_url=self.web_url)
+        if scenario == 'new_item':
+            return self.client.post('/items/new', json={'body': 'Benchmark item'}, base_url=self.web_url)
+        if scenario == 'toggle_item':
+            return self.client.patch('/item/%d/toggle' % self.item_id, base_url=self.web_url)
+        if scenario == 'api_items':
+            return self.client.get('/v1/user/items', headers=self.headers, base_url=self.api_url)
+        return self.client.get('/v1/user/items/%d' % self.item_id, headers=self.headers, base_url=self.api_url)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def run(app, scenarios, requests, concurrency):
+    """用concurrency个线程(每个线程一个用户)请求每个场景requests次, 返回每个场景的吞吐量, 延迟分位数和每个请求的SQL数量.
+
+    new_item和toggle_item会修改数据, 应在测试数据库上运行.
+    """
+    users = [(user.id, Item.query.with_parent(user).with_entities(Item.id).limit(1).scalar())
+             for user in User.query.order_by(User.id).limit(concurrency)]
+    users = [(user_id, item_id) for user_id, item_id in users if item_id is not None]
+    if not users:
+        raise ValueError('没有可用的用户和条目, 请先运行 flask seed')
+    clients = [Client(app, user_id, item_id) for user_id, item_id in users]
+
+    local = threading.local()
+
+    def count_statement(conn, cursor, statement, parameters, context, executemany):
+        local.statements = getattr(local, 'statements', 0) + 1
+
+    event.listen(Engine, 'before_cursor_execute', count_statement)
+    results = {}
+    try:
+        for scenario in scenarios:
+            latencies = []
+            statements = []
+            errors = []
+            lock = threading.Lock()
+
+            def worker(client, count):
+                for _ in range(count):
+                    local.statements = 0
+                    start = time.perf_counter()
+                    response = client.request(scenario)
+                    elapsed = time.perf_counter() - start
+                    with lock:
+                        latencies.append(elapsed)
+                        statements.append(local.statements)
+                        if response.status_code >= 400:
+                            errors.append(response.status_code)
+
+            threads = [threading.Thread(target=worker, args=(client, requests // len(clients) + (
+                1 if index < requests % len(clients) else 0))) for index, client in enumerate(clients)]
+            start = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            seconds = time.perf_counter() - start
+            latencies.sort()
+            results[scenario] = dict(
+                requests=len(latencies),
+                errors=len(errors),
+                seconds=round(seconds, 3),
+                throughput=round(len(latencies) / seconds, 1) if seconds else None,
+                p50_ms=round(percentile(latencies, 0.5) * 1000, 2),
+                p95_ms=round(percentile(latencies, 0.95) * 1000, 2),
+                p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+                sql_per_request=round(sum(statements) / len(statements), 2)
+            )
+    finally:
+        event.remove(Engine, 'before_cursor_execute', count_statement)
+    return dict(concurrency=len(clients), scenarios=results)
@@ -1,21 +1,104 @@
-from flask import Blueprint, render_template, request, jsonify
-from flask_babel import _
+from flask import Blueprint, render_template, request, jsonify, current_app, url_for, abort
+from flask_babel import _, get_locale
 from flask_login import login_required, current_user
+from markupsafe import Markup
+from sqlalchemy import and_, or_
 
-from ..extensions import db
-from ..modles import Item
+from ..extensions import db, use_replica, fragment_cache, event_broker
+from ..modles import Item, toggle_item_done, clear_completed_items, encode_cursor, parse_cursor
+from ..search import search_items
 
 todo_bp = Blueprint('todo', __name__)
 
 
+@todo_bp.app_template_global()
+def render_item(item):
+    """渲染条目片段, 按(条目, 更新时间, 区域)缓存渲染结果"""
+    key = '%d:%s:%s' % (item.id, item.updated_at.isoformat() if item.updated_at else '', get_locale())
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render_template('_item.html', item=item)
+        fragment_cache.set(key, html, tags=('item:%d' % item.id,))
+    return Markup(html)
+
+
+def page_items(item_filter, cursor=None):
+    """按创建顺序用游标分页获取当前用户的条目, 返回本页条目和下一页的地址"""
+    query = Item.query.with_parent(current_user)
+    if item_filter == 'active':
+        query = query.filter_by(done=False)
+    elif item_filter == 'completed':
+        query = query.filter_by(done=True)
+    elif item_filter != 'all':
+        abort(404)
+    if cursor:
+        try:
+            timestamp, item_id = parse_cursor(cursor)
+        except ValueError:
+            abort(400)
+        query = query.filter(or_(Item.timestamp > timestamp, and_(Item.timestamp == timestamp, Item.id > item_id)))
+    per_page = current_app.config['TODOISM_APP_ITEMS_PER_PAGE']
+    items = query.order_by(Item.timestamp, Item.id).limit(per_page + 1).all()
+    next_url = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_url = url_for('.items', filter=item_filter, cursor=encode_cursor(items[-1].timestamp, items[-1].id))
+    return items, next_url
+
+
 @todo_bp.route('/app')
 @login_required
+@use_replica
 def app():
-    all_count = Item.query.with_parent(current_user).count()
-    active_count = Item.query.with_parent(current_user).filter_by(done=False).count()
-    complete_count = Item.query.with_parent(current_user).filter_by(done=True).count()
-    return render_template('_app.html', all_count=all_count, active_count=active_count, complate_coun=complete_count,
-                           items=current_user.items)
+    items, next_url = page_items('all')
+    return render_template('_app.html', all_count=current_user.all_count, active_count=current_user.active_count,
+                           completed_count=current_user.completed_count, items=items, next_url=next_url)
+
+
+@todo_bp.route('/items')
+@login_required
+@use_replica
+def items():
+    items, next_url = page_items(request.args.get('filter', 'all'), request.args.get('cursor'))
+    return jsonify(html=render_template('_items.html', items=items), next=next_url)
+
+
+@todo_bp.route('/items/search')
+@login_required
+@use_replica
+def search():
+    keywords = request.args.get('q', '').strip()
+    if not keywords:
+        return jsonify(message=_('搜索关键词为空')), 400
+    page = max(request.args.get('page', 1, int), 1)
+    per_page = current_app.config['TODOISM_APP_ITEMS_PER_PAGE']
+    items = search_items(Item.query.with_parent(current_user), keywords).offset(
+        (page - 1) * per_page).limit(per_page + 1).all()
+    next_url = None
+    if len(items) > per_page:
+        items = items[:per_page]
+        next_url = url_for('.search', q=keywords, page=page + 1)
+    return jsonify(html=render_template('_items.html', items=items), next=next_url)
+
+
+def render_changes(event, data):
+    """为新增的条目渲染HTML片段, 页面可以直接插入.
+
+    事件数据由同一用户的所有连接共享, 因此复制后再修改; 直接使用Jinja模板, 不执行上下文处理函数, 避免查询数据库.
+    """
+    if event == 'change' and data['created']:
+        template = current_app.jinja_env.get_template('_item.html')
+        data = dict(data, created=[dict(item, html=template.render(item=item)) for item in data['created']])
+    return data
+
+
+@todo_bp.route('/events')
+@login_required
+def events():
+    subscription = event_broker.subscribe(current_user.id)
+    # 事件流会保持很久, 先归还数据库连接
+    db.session.remove()
+    return event_broker.response(subscription, render_changes)
 
 
 @todo_bp.route('/items/new', methods=['POST'])
@@ -27,7 +110,7 @@ def new_item():
     item = Item(body=data['body'], author=current_user._get_current_object())
     db.session.add(item)
     db.session.commit()
-    return jsonify(html=render_template('_item.html', item=item), message='+1')
+    return jsonify(html=render_item(item), message='+1')
 
 
 @todo_bp.route('/item/<int:item_id>/edit', methods=['PUT'])
@@ -47,6 +130,11 @@ def edit_item(item_id):
 @todo_bp.route('/item/<int:item_id>/toggle', methods=['PATCH'])
 @login_required
 def toggle_item(item_id):
+    if current_app.config['TODOISM_WRITE_COALESCING']:
+        if toggle_item_done(item_id, current_user.id):
+            return jsonify(message=_('更新成功'))
+        Item.query.get_or_404(item_id)
+        return jsonify(message=_('权限错误')), 403
     item = Item.query.get_or_404(item_id)
     if current_user != item.author:
         return jsonify(message=_('权限错误')), 403
@@ -62,14 +150,12 @@ def delete_item(item_id):
     if current_user != item.author:
         return jsonify(message=_('权限错误')), 403
     db.session.delete(item)
+    db.session.commit()
     return jsonify(message=_('删除成功'))
 
 
 @todo_bp.route('/item/clear', methods=['DELETE'])
 @login_required
 def clear_items():
-    items = Item.query.with_parent(current_user).filter_by(done=True).all()
-    for item in items:
-        db.session.delete(item)
-    db.session.commit()
-    return jsonify(message=_('已清理完成条目'))
+    count = clear_completed_items(current_user._get_current_object(), current_app.config['TODOISM_CLEAR_CHUNK_SIZE'])
+    return jsonify(message=_('已清理完成条目'), count=count)
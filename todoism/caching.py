@@ -0,0 +1,130 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class Cache(object):
+    """进程内有界LRU缓存, 条目按超时时间过期.
+
+    可以通过配置项 TODOISM_CACHE_BACKEND 提供一个共享后端(需实现 get/set/delete,
+    例如 cachelib 的缓存对象), 这时只使用共享后端, 一个进程的失效对所有进程生效. 标签用于按用户等维度批量失效,
+    共享后端中每个标签保存一个版本号, 条目记录写入时的版本号, 删除标签后这些条目不再命中.
+    """
+
+    def __init__(self, namespace, maxsize=1024, timeout=300):
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.backend = None
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app, maxsize=None, timeout=None):
+        if maxsize is not None:
+            self.maxsize = maxsize
+        if timeout is not None:
+            self.timeout = timeout
+        self.backend = app.config.get('TODOISM_CACHE_BACKEND')
+        self.clear()
+        app.extensions['%s_cache' % self.namespace] = self
+
+    def _key(self, key):
+        return '%s:%s' % (self.namespace, key)
+
+    def get(self, key):
+        if self.backend is not None:
+            value = self._backend_get(key)
+            with self._lock:
+                if value is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+            return value
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires, tags = entry
+                if expires > now:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._discard(key)
+            self.misses += 1
+        return None
+
+    def _backend_get(self, key):
+        entry = self.backend.get(self._key(key))
+        if entry is None or entry[1] <= time.time():
+            return None
+        value, expires, versions = entry
+        for tag, version in versions:
+            if self.backend.get(self._tag_key(tag)) != version:
+                return None
+        return value
+
+    def set(self, key, value, timeout=None, tags=()):
+        if timeout is None:
+            timeout = self.timeout
+        if timeout <= 0:
+            return
+        expires = time.time() + timeout
+        if self.backend is None:
+            with self._lock:
+                self._store(key, value, expires, tags)
+            return
+        versions = []
+        for tag in tags:
+            tag_key = self._tag_key(tag)
+            version = self.backend.get(tag_key) or uuid.uuid4().hex
+            # 版本号至少保留到这个条目过期, 版本号过期后条目只会未命中
+            self.backend.set(tag_key, version, timeout=int(timeout) + 1)
+            versions.append((tag, version))
+        self.backend.set(self._key(key), (value, expires, tuple(versions)), timeout=int(timeout) + 1)
+
+    def _tag_key(self, tag):
+        return self._key('tag:%s' % tag)
+
+    def _store(self, key, value, expires, tags=()):
+        self._discard(key)
+        self._data[key] = (value, expires, tuple(tags))
+        for tag in tags:
+            self._tags.setdefault(tag, set()).add(key)
+        while len(self._data) > self.maxsize:
+            self._discard(next(iter(self._data)))
+
+    def _discard(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            for tag in entry[2]:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+    def delete(self, key):
+        with self._lock:
+            self._discard(key)
+        if self.backend is not None:
+            self.backend.delete(self._key(key))
+
+    def delete_tag(self, tag):
+        with self._lock:
+            for key in list(self._tags.get(tag, ())):
+                self._discard(key)
+        if self.backend is not None:
+            self.backend.delete(self._tag_key(tag))
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._tags.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        return dict(size=len(self._data), maxsize=self.maxsize, hits=self.hits, misses=self.misses)
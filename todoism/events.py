@@ -0,0 +1,205 @@
+import json
+import os
+import queue
+import socket
+import threading
+import time
+import uuid
+
+from flask import current_app, stream_with_context
+
+
+class EventStreamBusy(Exception):
+    """事件流连接数达到上限"""
+
+
+class Subscription(object):
+    """一个事件流连接, 推送不及时的事件在有界队列中等待, 队列满时让客户端重新同步"""
+
+    def __init__(self, user_id, maxsize):
+        self.user_id = user_id
+        self.queue = queue.Queue(maxsize)
+        self.overflowed = False
+
+    def put(self, event, data):
+        try:
+            self.queue.put_nowait((event, data))
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout):
+        """返回下一个(event, data), 超时返回None"""
+        if self.overflowed:
+            return 'resync', {}
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class SocketTransport(object):
+    """多进程部署时在同一台机器的进程之间转发事件.
+
+    每个进程在directory中绑定一个Unix数据报套接字, 发送时把事件发给目录中所有的套接字(包括自己),
+    已退出的进程留下的套接字文件在发送失败时删除.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = None
+        self.sock = None
+
+    def listen(self, callback):
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, '%d-%s.sock' % (os.getpid(), uuid.uuid4().hex[:8]))
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.bind(self.path)
+        thread = threading.Thread(target=self._receive, args=(self.sock, callback), name='event-transport',
+                                  daemon=True)
+        thread.start()
+
+    @staticmethod
+    def _receive(sock, callback):
+        while True:
+            try:
+                data = sock.recv(65536)
+            except OSError:
+                return
+            callback(*json.loads(data.decode('utf-8')))
+
+    def send(self, user_id, event, data):
+        message = json.dumps([user_id, event, data]).encode('utf-8')
+        sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        # 在写操作提交之后发送, 不能因为某个不再读取的进程阻塞
+        sender.setblocking(False)
+        try:
+            for name in os.listdir(self.directory):
+                path = os.path.join(self.directory, name)
+                try:
+                    sender.sendto(message, path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    if path != self.path:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                except OSError:
+                    # 事件太大或对方接收缓冲区已满(BlockingIOError), 让对方的客户端重新同步
+                    try:
+                        sender.sendto(json.dumps([user_id, 'resync', {}]).encode('utf-8'), path)
+                    except OSError:
+                        pass
+        finally:
+            sender.close()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+
+
+class EventBroker(object):
+    """把写操作产生的条目事件推送给同一个用户的所有事件流连接.
+
+    默认只在当前进程内分发; 配置 TODOISM_EVENT_TRANSPORT (需实现listen(callback)和send(user_id, event, data))
+    或 TODOISM_EVENT_SOCKET_DIR 后通过它转发给所有进程, 由各进程在收到后分发.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.queue_size = 100
+        self.max_connections = 10000
+        self._subscriptions = {}
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.queue_size = app.config['TODOISM_EVENT_QUEUE_SIZE']
+        self.max_connections = app.config['TODOISM_EVENT_MAX_CONNECTIONS']
+        if self.transport is not None:
+            self.transport.close()
+        self.transport = app.config['TODOISM_EVENT_TRANSPORT']
+        if self.transport is None and app.config['TODOISM_EVENT_SOCKET_DIR']:
+            self.transport = SocketTransport(app.config['TODOISM_EVENT_SOCKET_DIR'])
+        if self.transport is not None:
+            self.transport.listen(self.deliver)
+        app.extensions['event_broker'] = self
+
+    def subscribe(self, user_id):
+        with self._lock:
+            if self._count >= self.max_connections:
+                raise EventStreamBusy()
+            subscription = Subscription(user_id, self.queue_size)
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+            self._count += 1
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None and subscription in subscriptions:
+                subscriptions.discard(subscription)
+                self._count -= 1
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, user_id, event, data):
+        if self.transport is not None:
+            self.transport.send(user_id, event, data)
+        else:
+            self.deliver(user_id, event, data)
+
+    def deliver(self, user_id, event, data):
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            subscription.put(event, data)
+
+    def stats(self):
+        with self._lock:
+            return dict(connections=self._count, users=len(self._subscriptions))
+
+    def response(self, subscription, render=None):
+        """返回推送subscription中事件的流式响应, render(event, data)可以在推送前补充数据"""
+        stream = self.stream(subscription, current_app.config['TODOISM_EVENT_HEARTBEAT'],
+                             current_app.config['TODOISM_EVENT_STREAM_TIMEOUT'], render)
+        response = current_app.response_class(stream_with_context(stream), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # 让Nginx等反向代理不要缓冲事件
+        response.headers['X-Accel-Buffering'] = 'no'
+        # 客户端在事件流开始之前断开时生成器不会执行, 关闭响应时也要取消订阅
+        response.call_on_close(lambda: self.unsubscribe(subscription))
+        return response
+
+    def stream(self, subscription, heartbeat, timeout, render=None):
+        """生成SSE格式的事件流.
+
+        没有事件时每隔heartbeat秒发送一行注释, 让代理保持连接并及时发现已断开的客户端;
+        timeout秒后发送reconnect事件并结束, 由客户端按retry重新连接. 队列溢出时发送resync事件并结束.
+        其他原因断开的连接可能错过了事件, 客户端重新连接后应重新同步.
+        """
+        try:
+            yield 'retry: 3000\n\n'
+            deadline = time.monotonic() + timeout
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    # 主动结束的连接, 客户端重新连接即可, 不需要重新同步
+                    yield 'event: reconnect\ndata: {}\n\n'
+                    return
+                message = subscription.get(min(heartbeat, remaining))
+                if message is None:
+                    yield ': ping\n\n'
+                    continue
+                event, data = message
+                if render is not None:
+                    data = render(event, data)
+                yield 'event: %s\ndata: %s\n\n' % (event, json.dumps(data, ensure_ascii=False))
+                if event == 'resync' and subscription.overflowed:
+                    return
+        finally:
+            self.unsubscribe(subscription)
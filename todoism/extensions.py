@@ -1,9 +1,21 @@
-from flask import request, current_app
+import random
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import request, current_app, g, has_request_context, _request_ctx_stack
 from flask_babel import Babel, _
 from flask_login import LoginManager, current_user
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 from flask_wtf.csrf import CSRFProtect
-from sqlalchemy import MetaData
+from itsdangerous import URLSafeTimedSerializer, BadSignature
+from sqlalchemy import MetaData, event, orm
+
+from .assets import Assets, Compressor
+from .batching import GroupCommit
+from .caching import Cache
+from .events import EventBroker
+from .metrics import Metrics
+from .security import HashingPool
 
 convention = {
     "ix": 'ix_%(column_0_label)s',
@@ -11,19 +23,153 @@ convention = {
     "fk": "fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s",
 }
 metadata = MetaData(naming_convention=convention)
-db = SQLAlchemy(metadata=metadata)
+
+
+class RoutingSession(SignallingSession):
+    """标记为只读的请求在没有未提交修改时从TODOISM_READ_REPLICAS中随机选择一个只读副本读取"""
+
+    def get_bind(self, mapper=None, clause=None):
+        replicas = self.app.config['TODOISM_READ_REPLICAS']
+        if replicas and has_request_context() and getattr(_request_ctx_stack.top, 'use_replica', False) \
+                and not self._flushing and not self.info.get('flushed') \
+                and not (self.new or self.dirty or self.deleted):
+            # 同一个请求的查询读取同一个副本, 避免各个副本的延迟不同导致数据不一致
+            ctx = _request_ctx_stack.top
+            if getattr(ctx, 'replica', None) is None:
+                ctx.replica = random.choice(replicas)
+            return db.get_engine(self.app, bind=ctx.replica)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = RoutingSQLAlchemy(metadata=metadata)
 login_manager = LoginManager()
 csrf = CSRFProtect()
 babel = Babel()
+token_cache = Cache('token')
+user_cache = Cache('user')
+# 刚写入过数据的用户在这段时间内读取主库, 保证读到自己的修改
+primary_pins = Cache('primary_pin')
+group_commit = GroupCommit()
+# 渲染好的条目HTML片段
+fragment_cache = Cache('fragment')
+metrics = Metrics()
+hashing_pool = HashingPool()
+# 推送给事件流的条目修改
+event_broker = EventBroker()
+compressor = Compressor()
+# 指纹化并预先压缩的静态文件
+assets = Assets()
 
 login_manager.login_view = 'auth.login'
 login_manager.login_message = _('登陆之后才能访问这个页面.')
 
 
+# 刚写入过数据的用户的签名cookie, 请求落在其他进程时同样读取主库
+PRIMARY_PIN_COOKIE = 'todoism_primary'
+
+
+def pin_serializer():
+    return URLSafeTimedSerializer(current_app.config['SECRET_KEY'], salt='primary-pin')
+
+
+def pin_primary(user_id):
+    """用户写入数据后在TODOISM_REPLICA_PIN_SECONDS内读取主库, 请求中的写入同时通过cookie通知其他进程"""
+    if not current_app.config['TODOISM_READ_REPLICAS']:
+        return
+    primary_pins.set(user_id, True)
+    if has_request_context():
+        g.primary_pin = user_id
+
+
+def primary_pinned(user_id):
+    if primary_pins.get(user_id) is not None:
+        return True
+    value = request.cookies.get(PRIMARY_PIN_COOKIE)
+    if value is None:
+        return False
+    try:
+        return pin_serializer().loads(value, max_age=current_app.config['TODOISM_REPLICA_PIN_SECONDS']) == user_id
+    except BadSignature:
+        return False
+
+
+def set_primary_pin_cookie(response):
+    user_id = g.pop('primary_pin', None)
+    if user_id is not None and current_app.config['TODOISM_READ_REPLICAS']:
+        # 网页和API在不同的子域名下, 与会话cookie使用相同的域名
+        response.set_cookie(PRIMARY_PIN_COOKIE, pin_serializer().dumps(user_id),
+                            max_age=current_app.config['TODOISM_REPLICA_PIN_SECONDS'], httponly=True,
+                            domain=current_app.session_interface.get_cookie_domain(current_app))
+    return response
+
+
+def use_replica(f):
+    """GET处理函数从只读副本读取, 当前用户刚写入过数据时仍然读取主库"""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        user = g.current_user if 'current_user' in g else current_user
+        if not user.is_authenticated or not primary_pinned(user.id):
+            _request_ctx_stack.top.use_replica = True
+        return f(*args, **kwargs)
+
+    return decorated
+
+
+def reads_replica():
+    """当前请求是否已标记为从只读副本读取"""
+    return bool(current_app.config['TODOISM_READ_REPLICAS']) and getattr(_request_ctx_stack.top, 'use_replica', False)
+
+
+@contextmanager
+def read_primary():
+    """在已标记为从只读副本读取的请求中临时读取主库"""
+    ctx = _request_ctx_stack.top
+    use_replica = getattr(ctx, 'use_replica', False)
+    ctx.use_replica = False
+    try:
+        yield
+    finally:
+        ctx.use_replica = use_replica
+
+
+@event.listens_for(db.session, 'after_flush')
+def mark_flushed(session, flush_context):
+    """事务中有未提交的写入时只能读取主库"""
+    session.info['flushed'] = True
+
+
+@event.listens_for(db.session, 'after_commit')
+@event.listens_for(db.session, 'after_rollback')
+def clear_flushed(session):
+    session.info.pop('flushed', None)
+
+
+def sqlite_pragmas(pragmas):
+    """返回在每个新SQLite连接上执行PRAGMA的connect事件处理函数"""
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+
+    return set_pragmas
+
+
 @login_manager.user_loader
 def load_user(user_id):
     from .modles import User
-    return User.query.get(int(user_id))
+    cached = user_cache.get(int(user_id))
+    if cached is not None:
+        return User.from_cache(cached)
+    user = User.query.get(int(user_id))
+    if user is not None:
+        user_cache.set(user.id, user.to_cache(), tags=(user.cache_tag,))
+    return user
 
 
 @babel.localeselector
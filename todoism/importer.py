@@ -0,0 +1,81 @@
+import csv
+import json
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from .extensions import db
+from .modles import Item, pending_changes
+
+
+def read_rows(lines, import_format):
+    """逐行解析NDJSON或CSV(与导出格式相同, 至少包含body列)"""
+    if import_format == 'csv':
+        for row in csv.DictReader(lines):
+            yield row
+    elif import_format == 'ndjson':
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    else:
+        raise ValueError('不支持的导入格式: %s' % import_format)
+
+
+def item_mapping(user, row):
+    body = row.get('body')
+    if body is None or str(body).strip() == '':
+        raise ValueError('消息内容为空')
+    done = row.get('done', False)
+    if isinstance(done, str):
+        done = done.strip().lower() in ('1', 'true', 'yes')
+    timestamp = row.get('timestamp')
+    timestamp = datetime.fromisoformat(timestamp) if timestamp else datetime.utcnow()
+    return dict(body=body, done=bool(done), timestamp=timestamp, author_id=user.id)
+
+
+def import_items(user, rows, chunk_size=1000, skip=0):
+    """按块批量插入条目, 每块一个事务.
+
+    失败时回滚当前块并在结果的resume_from中给出下一次应跳过的行数, 之前的块已经提交.
+    """
+    start = time.time()
+    imported = 0
+    chunk = []
+    chunk_start = skip
+    error = None
+    position = 0
+    try:
+        for row in rows:
+            if position >= skip:
+                chunk.append(item_mapping(user, row))
+            position += 1
+            if len(chunk) >= chunk_size:
+                insert_chunk(user, chunk)
+                imported += len(chunk)
+                chunk = []
+                chunk_start = position
+        if chunk:
+            insert_chunk(user, chunk)
+            imported += len(chunk)
+    except (ValueError, AttributeError, TypeError, csv.Error, SQLAlchemyError) as e:
+        db.session.rollback()
+        error = '第%d行: %s' % (position + 1, e)
+    else:
+        chunk_start = None
+    seconds = time.time() - start
+    return dict(
+        imported=imported,
+        seconds=round(seconds, 3),
+        rows_per_second=round(imported / seconds, 1) if seconds else None,
+        resume_from=chunk_start,
+        error=error
+    )
+
+
+def insert_chunk(user, chunk):
+    db.session.bulk_insert_mappings(Item, chunk)
+    user.change_counts(len(chunk), sum(1 for mapping in chunk if not mapping['done']))
+    # 批量插入的条目没有逐条的事件, 让客户端重新同步
+    pending_changes(db.session, user.id)['resync'] = True
+    db.session.commit()
@@ -0,0 +1,79 @@
+import copy
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener, SMTPHandler
+
+from flask import request, has_request_context
+
+
+class RequestQueueHandler(QueueHandler):
+    """把日志记录放入有界队列, 由QueueListener在后台线程中格式化和发送, 不阻塞请求.
+
+    队列已满时丢弃记录并计数. 只在请求线程中记录请求的URL和地址, 格式化在后台线程中进行.
+    """
+
+    def __init__(self, maxsize=1000):
+        super(RequestQueueHandler, self).__init__(queue.Queue(maxsize))
+        self.dropped = 0
+        self.listener = None
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        if has_request_context():
+            record.url = request.url
+            record.remote_addr = request.remote_addr
+        else:
+            record.url = record.remote_addr = '-'
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def listen(self, *handlers):
+        self.listener = QueueListener(self.queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.stop()
+            for handler in self.listener.handlers:
+                handler.close()
+            self.listener = None
+        super(RequestQueueHandler, self).close()
+
+
+class ThrottledSMTPHandler(SMTPHandler):
+    """同一位置的错误在interval秒内只发送一封邮件, 下一封邮件中注明被忽略的次数"""
+
+    def __init__(self, *args, interval=300, **kwargs):
+        super(ThrottledSMTPHandler, self).__init__(*args, **kwargs)
+        self.interval = interval
+        self._sent = {}
+        self._suppressed = {}
+        self._throttle_lock = threading.Lock()
+
+    @staticmethod
+    def key(record):
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        return record.pathname, record.lineno, exc_type
+
+    def emit(self, record):
+        key = self.key(record)
+        now = time.monotonic()
+        with self._throttle_lock:
+            if now - self._sent.get(key, -self.interval) < self.interval:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            self._sent[key] = now
+            record.suppressed = self._suppressed.pop(key, 0)
+        super(ThrottledSMTPHandler, self).emit(record)
+
+    def getSubject(self, record):
+        subject = super(ThrottledSMTPHandler, self).getSubject(record)
+        if getattr(record, 'suppressed', 0):
+            subject += ' (+%d)' % record.suppressed
+        return subject
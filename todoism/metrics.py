@@ -0,0 +1,190 @@
+import hmac
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+from flask import g, request, current_app, has_request_context, abort
+from flask.signals import signals_available, before_render_template, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for index, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[index] += 1
+
+
+class Metrics(object):
+    """按接口统计请求耗时, SQL语句数量和耗时, 模板渲染和序列化耗时, 以Prometheus文本格式导出.
+
+    设置 TODOISM_METRICS 开启; 同一个请求中同一条SQL执行超过 TODOISM_N_PLUS_ONE_THRESHOLD 次时记录警告(N+1查询).
+    /metrics只允许持有 TODOISM_METRICS_TOKEN 或来自 TODOISM_METRICS_ALLOWED_IPS 的请求读取.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.threshold = 5
+        self._lock = threading.Lock()
+        self.reset()
+
+    def init_app(self, app):
+        self.enabled = app.config['TODOISM_METRICS']
+        self.threshold = app.config['TODOISM_N_PLUS_ONE_THRESHOLD']
+        self.reset()
+        app.extensions['metrics'] = self
+        # 关闭统计时/metrics返回404, 不注册其他钩子, 不增加请求和SQL的开销
+        if 'metrics' not in app.view_functions:
+            app.add_url_rule('/metrics', 'metrics', self.export)
+        # 同一个程序多次调用init_app(例如在测试中开启统计)时只注册一次
+        if not self.enabled or self.start_request in app.before_request_funcs.get(None, ()):
+            return
+        app.before_request(self.start_request)
+        app.after_request(self.finish_request)
+        # 监听所有Engine, 包括只读副本
+        if not event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.listen(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.listen(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        if signals_available:
+            before_render_template.connect(self.before_render, app)
+            template_rendered.connect(self.after_render, app)
+
+    def remove_app(self, app):
+        """关闭统计并移除init_app注册的钩子, 例如在测试结束时"""
+        self.enabled = False
+        if self.start_request in app.before_request_funcs.get(None, ()):
+            app.before_request_funcs[None].remove(self.start_request)
+            app.after_request_funcs[None].remove(self.finish_request)
+        if event.contains(Engine, 'before_cursor_execute', self.before_cursor_execute):
+            event.remove(Engine, 'before_cursor_execute', self.before_cursor_execute)
+            event.remove(Engine, 'after_cursor_execute', self.after_cursor_execute)
+        if signals_available:
+            before_render_template.disconnect(self.before_render, app)
+            template_rendered.disconnect(self.after_render, app)
+
+    def reset(self):
+        with self._lock:
+            self.latency = defaultdict(_Histogram)
+            self.totals = defaultdict(Counter)
+
+    @staticmethod
+    def _current():
+        if has_request_context():
+            return g.get('_metrics')
+        return None
+
+    def start_request(self):
+        g._metrics = dict(start=time.perf_counter(), sql=0, sql_seconds=0.0, template=0.0, serialization=0.0,
+                          statements=Counter(), rendering=[])
+
+    def finish_request(self, response):
+        stats = g.pop('_metrics', None)
+        if stats is None:
+            return response
+        endpoint = request.endpoint or 'unknown'
+        repeated = [(statement, count) for statement, count in stats['statements'].items()
+                    if count > self.threshold]
+        for statement, count in repeated:
+            current_app.logger.warning('N+1 query in %s: executed %d times: %s', endpoint, count, statement)
+        with self._lock:
+            self.latency[endpoint].observe(time.perf_counter() - stats['start'])
+            totals = self.totals[endpoint]
+            totals['sql_statements'] += stats['sql']
+            totals['sql_seconds'] += stats['sql_seconds']
+            totals['template_seconds'] += stats['template']
+            totals['serialization_seconds'] += stats['serialization']
+            totals['n_plus_one'] += len(repeated)
+        return response
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self._current()
+        if stats is not None:
+            context._metrics_start = time.perf_counter()
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        stats = self._current()
+        start = getattr(context, '_metrics_start', None)
+        if stats is not None and start is not None:
+            stats['sql'] += 1
+            stats['sql_seconds'] += time.perf_counter() - start
+            stats['statements'][statement] += 1
+
+    def before_render(self, app, template, context):
+        stats = self._current()
+        if stats is not None:
+            stats['rendering'].append(time.perf_counter())
+
+    def after_render(self, app, template, context):
+        stats = self._current()
+        if stats is not None and stats['rendering']:
+            start = stats['rendering'].pop()
+            # 片段在外层模板中渲染时只统计最外层的耗时
+            if not stats['rendering']:
+                stats['template'] += time.perf_counter() - start
+
+    @contextmanager
+    def timer(self, name):
+        """统计一段代码的耗时, 目前用于序列化"""
+        stats = self._current() if self.enabled else None
+        if stats is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            stats[name] += time.perf_counter() - start
+
+    @staticmethod
+    def allowed():
+        token = current_app.config['TODOISM_METRICS_TOKEN']
+        if token and hmac.compare_digest(request.headers.get('Authorization', '').encode('utf-8'),
+                                         ('Bearer %s' % token).encode('utf-8')):
+            return True
+        return request.remote_addr in current_app.config['TODOISM_METRICS_ALLOWED_IPS']
+
+    def export(self):
+        if not self.enabled:
+            abort(404)
+        if not self.allowed():
+            abort(403)
+        lines = []
+        with self._lock:
+            lines.append('# HELP todoism_request_duration_seconds Request latency by endpoint.')
+            lines.append('# TYPE todoism_request_duration_seconds histogram')
+            for endpoint, histogram in sorted(self.latency.items()):
+                for bound, count in zip(BUCKETS, histogram.buckets):
+                    lines.append('todoism_request_duration_seconds_bucket{endpoint="%s",le="%s"} %d'
+                                 % (endpoint, bound, count))
+                lines.append('todoism_request_duration_seconds_bucket{endpoint="%s",le="+Inf"} %d'
+                             % (endpoint, histogram.count))
+                lines.append('todoism_request_duration_seconds_sum{endpoint="%s"} %.6f' % (endpoint, histogram.sum))
+                lines.append('todoism_request_duration_seconds_count{endpoint="%s"} %d' % (endpoint, histogram.count))
+            for name, help_text in (('sql_statements', 'SQL statements executed.'),
+                                    ('sql_seconds', 'Time spent executing SQL.'),
+                                    ('template_seconds', 'Time spent rendering templates.'),
+                                    ('serialization_seconds', 'Time spent building and encoding JSON.'),
+                                    ('n_plus_one', 'Requests that repeated one SQL statement too many times.')):
+                lines.append('# HELP todoism_%s_total %s' % (name, help_text))
+                lines.append('# TYPE todoism_%s_total counter' % name)
+                for endpoint, totals in sorted(self.totals.items()):
+                    lines.append('todoism_%s_total{endpoint="%s"} %s' % (name, endpoint, round(totals[name], 6)))
+        lines.append('# HELP todoism_cache_requests_total Cache lookups.')
+        lines.append('# TYPE todoism_cache_requests_total counter')
+        for name, extension in sorted(current_app.extensions.items()):
+            if name.endswith('_cache'):
+                stats = extension.stats()
+                lines.append('todoism_cache_requests_total{cache="%s",result="hit"} %d' % (name[:-6], stats['hits']))
+                lines.append('todoism_cache_requests_total{cache="%s",result="miss"} %d' % (name[:-6], stats['misses']))
+        return current_app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
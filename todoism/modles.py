@@ -1,9 +1,16 @@
-from datetime import datetime
+import hashlib
+import secrets
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime, timedelta
 
+from flask import request, has_request_context
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import make_transient_to_detached, object_session
+from sqlalchemy.orm.util import identity_key
 
-from .extensions import db
+from .extensions import db, token_cache, user_cache, pin_primary, group_commit, fragment_cache, hashing_pool, \
+    event_broker
 
 
 class User(db.Model, UserMixin):
@@ -11,6 +18,9 @@ class User(db.Model, UserMixin):
     username = db.Column(db.String(30), unique=True)
     _password_hash = db.Column(db.String(128))
     locale = db.Column(db.String(20), )
+    all_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    active_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    item_version = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     items = db.relationship('Item', back_populates='author', cascade='all')
 
     @property
@@ -19,19 +29,349 @@ class User(db.Model, UserMixin):
 
     @password.setter
     def password(self, password):
-        self._password_hash = generate_password_hash(password)
+        self._password_hash = hashing_pool.generate(password)
+
+    @property
+    def completed_count(self):
+        return self.all_count - self.active_count
 
     def validate_password(self, password):
-        return check_password_hash(self._password_hash, password)
+        return hashing_pool.check(self._password_hash, password)
+
+    @property
+    def cache_tag(self):
+        return 'user:%d' % self.id
+
+    def to_cache(self):
+        # 只缓存身份字段和区域, 计数等经常变化的字段不缓存; 区域修改后清除缓存,
+        # 其他进程最多在缓存超时之内使用旧的区域
+        return dict(id=self.id, username=self.username, locale=self.locale)
+
+    @classmethod
+    def from_cache(cls, data):
+        """用缓存的字段还原用户, 不查询数据库; 其他字段(计数等)在第一次访问时从数据库读取"""
+        user = cls(**data)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    def change_counts(self, all_count=0, active_count=0):
+        """在当前事务中调整条目计数并增加条目版本号, 已持久化的用户使用SQL表达式避免并发覆盖"""
+        if inspect(self).persistent:
+            if all_count:
+                self.all_count = User.all_count + all_count
+            if active_count:
+                self.active_count = User.active_count + active_count
+            self.item_version = User.item_version + 1
+        else:
+            self.all_count = (self.all_count or 0) + all_count
+            self.active_count = (self.active_count or 0) + active_count
+            self.item_version = (self.item_version or 0) + 1
 
     def __repr__(self):
         return '<User: %r>' % self.username
 
 
 class Item(db.Model):
+    __table_args__ = (
+        db.Index('ix_item_author_id_timestamp', 'author_id', 'timestamp', 'id'),
+        db.Index('ix_item_author_id_done_timestamp', 'author_id', 'done', 'timestamp', 'id'),
+        db.Index('ix_item_author_id_updated_at', 'author_id', 'updated_at', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.Text)
     done = db.Column(db.Boolean, default=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     author = db.relationship('User', back_populates='items')
+
+
+class ItemTombstone(db.Model):
+    """已删除条目的记录, 供增量同步接口返回删除操作"""
+    __table_args__ = (
+        db.Index('ix_item_tombstone_author_id_deleted_at', 'author_id', 'deleted_at', 'item_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    item_id = db.Column(db.Integer, nullable=False)
+    author_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'))
+    deleted_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+
+def item_etag(user_id):
+    """条目的任何修改都会改变这个值, 用于条件请求; 只查询两列, 按当前请求选择主库或只读副本.
+
+    只读副本上还没有该用户时返回None.
+    """
+    row = db.session.query(User.item_version, User.all_count).filter(User.id == user_id).first()
+    if row is None:
+        return None
+    return '%d-%d-%d' % (user_id, row.item_version, row.all_count)
+
+
+def encode_cursor(timestamp, item_id):
+    """把排序键编码为分页游标"""
+    raw = '%s|%d' % (timestamp.isoformat(), item_id)
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def parse_cursor(cursor):
+    """解析分页游标, 无效时抛出ValueError"""
+    raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+    timestamp, item_id = raw.rsplit('|', 1)
+    return datetime.fromisoformat(timestamp), int(item_id)
+
+
+class RefreshToken(db.Model):
+    """刷新令牌, 只保存令牌的SHA-256摘要"""
+    id = db.Column(db.Integer, primary_key=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete='CASCADE'), index=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    revoked_at = db.Column(db.DateTime)
+    user = db.relationship('User')
+
+    @staticmethod
+    def hash(token):
+        return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def issue(cls, user, expiration):
+        """为用户生成新的刷新令牌, 返回令牌字符串"""
+        token = secrets.token_urlsafe(32)
+        db.session.add(cls(token_hash=cls.hash(token), user=user,
+                           expires_at=datetime.utcnow() + timedelta(seconds=expiration)))
+        return token
+
+    @classmethod
+    def find(cls, token):
+        return cls.query.filter_by(token_hash=cls.hash(token)).first()
+
+    @classmethod
+    def revoke(cls, token_id):
+        """用一条条件UPDATE撤销令牌, 返回False表示令牌已被撤销, 包括被并发的请求抢先撤销"""
+        return cls.query.filter(cls.id == token_id, cls.revoked_at.is_(None)).update(
+            {cls.revoked_at: datetime.utcnow()}, synchronize_session=False) == 1
+
+    @classmethod
+    def revoke_all(cls, user_id):
+        cls.query.filter(cls.user_id == user_id, cls.revoked_at.is_(None)).update(
+            {cls.revoked_at: datetime.utcnow()}, synchronize_session=False)
+
+
+def rebuild_item_counts():
+    """用一条UPDATE语句重新统计所有用户的条目计数"""
+    all_count = db.session.query(db.func.count(Item.id)).filter(Item.author_id == User.id).as_scalar()
+    active_count = db.session.query(db.func.count(Item.id)).filter(
+        Item.author_id == User.id, Item.done == db.false()).as_scalar()
+    User.query.update({User.all_count: all_count, User.active_count: active_count,
+                       User.item_version: User.item_version + 1}, synchronize_session=False)
+
+
+def clear_completed_items(user, chunk_size=500):
+    """按块删除用户所有已完成的条目, 每块写入删除记录, 调整计数并提交一次, 返回删除的条数"""
+    deleted = 0
+    while True:
+        ids = [item_id for item_id, in db.session.query(Item.id).filter(
+            Item.author_id == user.id, Item.done == db.true()).limit(chunk_size)]
+        if not ids:
+            return deleted
+        query = Item.query.filter(Item.id.in_(ids))
+        record_deletions(query)
+        count = query.delete(synchronize_session=False)
+        for item_id in ids:
+            item = db.session.identity_map.get(identity_key(Item, item_id))
+            if item is not None:
+                db.session.expunge(item)
+        user.change_counts(-count)
+        changes = pending_changes(db.session, user.id)
+        changes['deleted'].update(ids)
+        changes['counts'][0] -= count
+        db.session.commit()
+        deleted += count
+
+
+def toggle_item_done(item_id, user_id):
+    """不预先读取条目, 用一条UPDATE切换完成状态并调整作者计数, 与并发的其他写操作合并提交.
+
+    在同一事务中读取切换后的条目用于推送事件. 返回False表示条目不存在或不属于该用户.
+    """
+    def statement(connection):
+        result = connection.execute(Item.__table__.update().where(Item.id == item_id).where(
+            Item.author_id == user_id).values(done=db.not_(Item.done)))
+        if not result.rowcount:
+            return None
+        item = connection.execute(db.select([Item.body, Item.done]).where(Item.id == item_id)).first()
+        connection.execute(User.__table__.update().where(User.id == user_id).values(
+            active_count=User.active_count + (-1 if item.done else 1), item_version=User.item_version + 1))
+        return item
+
+    item = group_commit.submit(db.engine, statement)
+    if item is None:
+        return False
+    # UPDATE语句不会触发ORM事件, 手动清除条目片段, 并让当前会话中的旧对象重新加载
+    fragment_cache.delete_tag('item:%d' % item_id)
+    pin_primary(user_id)
+    for key in (identity_key(Item, item_id), identity_key(User, user_id)):
+        obj = db.session.identity_map.get(key)
+        if obj is not None:
+            db.session.expire(obj)
+    changes = new_changes()
+    changes['updated'][item_id] = dict(id=item_id, body=item.body, done=item.done)
+    changes['counts'][1] = -1 if item.done else 1
+    publish_changes(user_id, changes)
+    return True
+
+
+def record_deletions(query):
+    """批量删除条目之前调用, 用INSERT ... SELECT为query选中的条目写入删除记录"""
+    select = query.with_entities(Item.id, Item.author_id, db.literal(datetime.utcnow())).order_by(None)
+    db.session.execute(ItemTombstone.__table__.insert().from_select(['item_id', 'author_id', 'deleted_at'],
+                                                                    select.statement))
+
+
+@event.listens_for(db.session, 'before_flush')
+def update_item_counts(session, flush_context, instances):
+    """根据本次flush中新增, 删除和修改的条目维护用户计数和条目版本号, 并为删除的条目写入删除记录"""
+    counts = {}
+
+    def count(item, all_count, active_count):
+        author = item.author
+        if author is None or author in session.deleted:
+            return False
+        deltas = counts.setdefault(author, [0, 0])
+        deltas[0] += all_count
+        deltas[1] += active_count
+        return True
+
+    with session.no_autoflush:
+        for obj in session.new:
+            if isinstance(obj, Item):
+                count(obj, 1, 0 if obj.done else 1)
+        for obj in session.deleted:
+            if isinstance(obj, Item):
+                done = inspect(obj).committed_state.get('done', obj.done)
+                if count(obj, -1, 0 if done else -1):
+                    session.add(ItemTombstone(item_id=obj.id, author_id=obj.author_id))
+        for obj in session.dirty:
+            if isinstance(obj, Item) and obj not in session.deleted and session.is_modified(obj):
+                history = inspect(obj).attrs.done.history
+                old = obj.done
+                if history.has_changes():
+                    old = history.deleted[0] if history.deleted else False
+                count(obj, 0, int(bool(old)) - int(bool(obj.done)))
+    for user, (all_count, active_count) in counts.items():
+        user.change_counts(all_count, active_count)
+        if user.id is not None:
+            deltas = pending_changes(session, user.id)['counts']
+            deltas[0] += all_count
+            deltas[1] += active_count
+
+
+def new_changes():
+    return dict(created={}, updated={}, deleted=set(), counts=[0, 0], resync=False)
+
+
+def pending_changes(session, user_id):
+    """当前事务中某个用户的条目修改, 提交后作为一个事件推送给该用户的事件流"""
+    return session.info.setdefault('item_changes', {}).setdefault(user_id, new_changes())
+
+
+def publish_changes(user_id, changes):
+    """推送change事件(新增和修改的条目, 删除的条目ID, 计数的变化); 无法逐条描述的修改(例如导入)推送resync事件.
+
+    origin是发起修改的客户端在X-Client-Id请求头中提供的标识, 客户端据此忽略自己的修改.
+    """
+    origin = request.headers.get('X-Client-Id') if has_request_context() else None
+    if changes['resync']:
+        event_broker.publish(user_id, 'resync', dict(origin=origin))
+    elif changes['created'] or changes['updated'] or changes['deleted'] or any(changes['counts']):
+        event_broker.publish(user_id, 'change', dict(
+            origin=origin,
+            created=list(changes['created'].values()),
+            updated=list(changes['updated'].values()),
+            deleted=sorted(changes['deleted']),
+            counts=changes['counts']
+        ))
+
+
+@event.listens_for(db.session, 'after_flush')
+def collect_item_changes(session, flush_context):
+    """记录本次flush中新增, 修改和删除的条目"""
+    for obj in session.new:
+        if isinstance(obj, Item):
+            pending_changes(session, obj.author_id)['created'][obj.id] = dict(id=obj.id, body=obj.body, done=obj.done)
+    for obj in session.dirty:
+        if isinstance(obj, Item) and obj not in session.deleted and session.is_modified(obj):
+            changes = pending_changes(session, obj.author_id)
+            data = dict(id=obj.id, body=obj.body, done=obj.done)
+            if obj.id in changes['created']:
+                changes['created'][obj.id] = data
+            else:
+                changes['updated'][obj.id] = data
+    for obj in session.deleted:
+        if isinstance(obj, Item):
+            changes = pending_changes(session, obj.author_id)
+            changes['created'].pop(obj.id, None)
+            changes['updated'].pop(obj.id, None)
+            changes['deleted'].add(obj.id)
+
+
+# 修改后需要清除用户缓存的字段: User.to_cache中的字段, 以及修改后应让令牌缓存失效的密码
+CACHE_INVALIDATING_FIELDS = ('username', 'locale', '_password_hash')
+
+
+def invalidate_user(mapper, connection, target):
+    """用户被删除后清除缓存, 事务提交后再清除一次, 避免并发请求缓存旧数据"""
+    invalidate_user_cache(target.id)
+    object_session(target).info.setdefault('invalidated_users', set()).add(target.id)
+
+
+def user_updated(mapper, connection, target):
+    """条目的写操作都会更新用户的计数, 只有CACHE_INVALIDATING_FIELDS被修改时才清除缓存"""
+    object_session(target).info.setdefault('written_users', set()).add(target.id)
+    state = inspect(target)
+    if any(state.attrs[name].history.has_changes() for name in CACHE_INVALIDATING_FIELDS):
+        invalidate_user(mapper, connection, target)
+
+
+def invalidate_user_cache(user_id):
+    token_cache.delete_tag('user:%d' % user_id)
+    user_cache.delete_tag('user:%d' % user_id)
+
+
+event.listen(User, 'after_update', user_updated)
+event.listen(User, 'after_delete', invalidate_user)
+
+
+def invalidate_item(mapper, connection, target):
+    """条目被修改或删除后清除渲染好的片段"""
+    fragment_cache.delete_tag('item:%d' % target.id)
+
+
+event.listen(Item, 'after_update', invalidate_item)
+event.listen(Item, 'after_delete', invalidate_item)
+
+
+@event.listens_for(db.session, 'after_commit')
+def invalidate_committed_users(session):
+    """条目的写操作都会更新用户, 因此把这些用户固定到主库一段时间"""
+    for user_id in session.info.pop('invalidated_users', ()):
+        invalidate_user_cache(user_id)
+    for user_id in session.info.pop('written_users', ()):
+        pin_primary(user_id)
+
+
+@event.listens_for(db.session, 'after_commit')
+def publish_committed_changes(session):
+    for user_id, changes in session.info.pop('item_changes', {}).items():
+        publish_changes(user_id, changes)
+
+
+@event.listens_for(db.session, 'after_rollback')
+def discard_invalidated_users(session):
+    session.info.pop('invalidated_users', None)
+    session.info.pop('written_users', None)
+    session.info.pop('item_changes', None)
@@ -0,0 +1,106 @@
+import sqlite3
+from functools import lru_cache
+
+from flask import current_app
+from sqlalchemy import event, func, literal_column, text
+from sqlalchemy.sql import column, table
+
+from .extensions import db
+from .modles import Item
+
+# SQLite的FTS5外部内容表, 只保存索引, 内容从item表读取, 由触发器保持同步
+item_fts = table('item_fts', column('rowid'))
+
+
+@lru_cache()
+def fts5_supports(tokenizer):
+    """当前SQLite库是否支持使用该分词器的FTS5表, 例如trigram需要SQLite 3.34以上"""
+    connection = sqlite3.connect(':memory:')
+    try:
+        connection.execute("CREATE VIRTUAL TABLE test_fts USING fts5(body, tokenize='%s')" % tokenizer)
+    except sqlite3.Error:
+        return False
+    finally:
+        connection.close()
+    return True
+
+
+def search_tokenizer():
+    """实际使用的FTS5分词器: 不支持配置的分词器时使用unicode61, 没有FTS5时返回None, 搜索改用LIKE"""
+    tokenizer = current_app.config['TODOISM_SEARCH_TOKENIZER']
+    if fts5_supports(tokenizer):
+        return tokenizer
+    if fts5_supports('unicode61'):
+        return 'unicode61'
+    return None
+
+
+def create_search_index(target, connection, **kw):
+    """创建全文索引: SQLite使用FTS5虚拟表和触发器, PostgreSQL使用GIN表达式索引"""
+    if connection.dialect.name == 'sqlite':
+        tokenizer = search_tokenizer()
+        if tokenizer is None:
+            return
+        connection.execute("CREATE VIRTUAL TABLE IF NOT EXISTS item_fts USING fts5(body, content='item', "
+                           "content_rowid='id', tokenize='%s')" % tokenizer)
+        connection.execute('CREATE TRIGGER IF NOT EXISTS item_fts_insert AFTER INSERT ON item BEGIN '
+                           'INSERT INTO item_fts(rowid, body) VALUES (new.id, new.body); END')
+        connection.execute('CREATE TRIGGER IF NOT EXISTS item_fts_delete AFTER DELETE ON item BEGIN '
+                           "INSERT INTO item_fts(item_fts, rowid, body) VALUES ('delete', old.id, old.body); END")
+        connection.execute('CREATE TRIGGER IF NOT EXISTS item_fts_update AFTER UPDATE OF body ON item BEGIN '
+                           "INSERT INTO item_fts(item_fts, rowid, body) VALUES ('delete', old.id, old.body); "
+                           'INSERT INTO item_fts(rowid, body) VALUES (new.id, new.body); END')
+    elif connection.dialect.name == 'postgresql':
+        connection.execute("CREATE INDEX IF NOT EXISTS ix_item_body_search ON item "
+                           "USING gin (to_tsvector('simple', coalesce(body, '')))")
+
+
+def drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        connection.execute('DROP TABLE IF EXISTS item_fts')
+
+
+def rebuild_search_index():
+    """根据item表重建全文索引, 用于升级已有的数据库"""
+    connection = db.session.connection()
+    create_search_index(Item.__table__, connection)
+    if connection.dialect.name == 'sqlite' and search_tokenizer() is not None:
+        connection.execute("INSERT INTO item_fts(item_fts) VALUES ('rebuild')")
+
+
+event.listen(Item.__table__, 'after_create', create_search_index)
+event.listen(Item.__table__, 'before_drop', drop_search_index)
+
+
+def match_expression(terms):
+    """把关键词转换为FTS5短语, 避免用户输入被解析为查询语法"""
+    return ' '.join('"%s"' % term.replace('"', '""') for term in terms)
+
+
+def search_items(query, keywords):
+    """在query中搜索包含所有关键词的条目, 按相关度排序"""
+    terms = keywords.split()
+    dialect = db.session.get_bind(Item.__mapper__).dialect.name
+    tokenizer = search_tokenizer() if dialect == 'sqlite' else None
+    if tokenizer is not None:
+        # trigram分词器支持中文等没有空格分隔的文本, 但只能匹配至少3个字符的关键词
+        if tokenizer.startswith('trigram'):
+            indexed = [term for term in terms if len(term) >= 3]
+        else:
+            indexed = terms
+        for term in terms:
+            if term not in indexed:
+                query = query.filter(Item.body.contains(term, autoescape=True))
+        if indexed:
+            # 按FTS5内置的rank列(bm25)排序时由FTS5直接返回排好序的结果, 不需要额外排序
+            return query.join(item_fts, item_fts.c.rowid == Item.id).filter(
+                text('item_fts MATCH :match').bindparams(match=match_expression(indexed))).order_by(
+                literal_column('item_fts.rank'))
+    elif dialect == 'postgresql':
+        vector = func.to_tsvector('simple', func.coalesce(Item.body, ''))
+        ts_query = func.plainto_tsquery('simple', keywords)
+        query = query.filter(vector.op('@@')(ts_query)).order_by(func.ts_rank(vector, ts_query).desc())
+    else:
+        for term in terms:
+            query = query.filter(Item.body.contains(term, autoescape=True))
+    return query.order_by(Item.timestamp.desc(), Item.id.desc())
@@ -0,0 +1,61 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HashingPoolBusy(Exception):
+    """等待计算的密码哈希过多"""
+
+
+class HashingPool(object):
+    """在固定数量的工作线程中计算密码哈希.
+
+    PBKDF2计算时会释放GIL, 限制同时计算的数量可以避免登录高峰占满所有CPU;
+    排队的任务超过 TODOISM_PASSWORD_QUEUE_SIZE 时直接抛出HashingPoolBusy, 不再让请求继续等待.
+    未调用init_app时在当前线程中计算.
+    """
+
+    def __init__(self):
+        self.executor = None
+        self.max_pending = 0
+        self.timeout = None
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.executor = ThreadPoolExecutor(app.config['TODOISM_PASSWORD_WORKERS'], thread_name_prefix='password')
+        self.max_pending = app.config['TODOISM_PASSWORD_QUEUE_SIZE']
+        self.timeout = app.config['TODOISM_PASSWORD_TIMEOUT']
+        app.extensions['hashing_pool'] = self
+
+    def _run(self, func, *args):
+        if self.executor is None:
+            return func(*args)
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise HashingPoolBusy()
+            self._pending += 1
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self._release()
+            raise
+        # 等待超时后哈希仍在工作线程中计算, 计算完成后才释放名额, 排队和计算中的任务总数不会超过上限
+        future.add_done_callback(self._release)
+        try:
+            return future.result(self.timeout)
+        except TimeoutError:
+            raise HashingPoolBusy()
+
+    def _release(self, future=None):
+        with self._lock:
+            self._pending -= 1
+
+    def generate(self, password):
+        return self._run(generate_password_hash, password)
+
+    def check(self, pwhash, password):
+        return self._run(check_password_hash, pwhash, password)
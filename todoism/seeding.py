@@ -0,0 +1,41 @@
+import random
+from datetime import datetime, timedelta
+
+from .extensions import db, hashing_pool
+from .modles import User, Item, rebuild_item_counts
+
+
+def seed(users, items_per_user, password='12345678', chunk_size=5000, locale='zh_CN'):
+    """批量生成用户和条目, 所有用户使用同一个密码(只计算一次哈希), 返回生成的用户名"""
+    from faker import Faker
+
+    fake = Faker(locale)
+    password_hash = hashing_pool.generate(password)
+    now = datetime.utcnow()
+    usernames = []
+    existing = {username for username, in db.session.query(User.username)}
+    while len(usernames) < users:
+        username = fake.user_name()[:24] + str(random.randint(0, 99999))
+        if username not in existing:
+            existing.add(username)
+            usernames.append(username)
+    last_id = db.session.query(db.func.max(User.id)).scalar() or 0
+    db.session.bulk_insert_mappings(User, [dict(username=username, _password_hash=password_hash)
+                                           for username in usernames])
+    db.session.commit()
+
+    chunk = []
+    for user_id, in db.session.query(User.id).filter(User.id > last_id).all():
+        for _ in range(items_per_user):
+            timestamp = now - timedelta(seconds=random.randint(0, 90 * 24 * 3600))
+            chunk.append(dict(body=fake.sentence(), done=random.random() < 0.3, timestamp=timestamp,
+                              updated_at=timestamp, author_id=user_id))
+            if len(chunk) >= chunk_size:
+                db.session.bulk_insert_mappings(Item, chunk)
+                db.session.commit()
+                chunk = []
+    if chunk:
+        db.session.bulk_insert_mappings(Item, chunk)
+    rebuild_item_counts()
+    db.session.commit()
+    return usernames
@@ -3,31 +3,145 @@ import os
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
+def engine_options(uri):
+    """根据数据库类型生成SQLALCHEMY_ENGINE_OPTIONS, 服务器数据库使用可配置的连接池"""
+    if uri.startswith('sqlite'):
+        # 等待写锁的秒数, 与PRAGMA busy_timeout一致
+        return dict(connect_args=dict(timeout=int(os.getenv('SQLITE_BUSY_TIMEOUT', 15000)) / 1000))
+    return dict(
+        pool_size=int(os.getenv('DATABASE_POOL_SIZE', 10)),
+        max_overflow=int(os.getenv('DATABASE_MAX_OVERFLOW', 20)),
+        pool_timeout=int(os.getenv('DATABASE_POOL_TIMEOUT', 30)),
+        pool_recycle=int(os.getenv('DATABASE_POOL_RECYCLE', 1800)),
+        pool_pre_ping=True
+    )
+
+
 class Base:
     TODOISM_LOCALES = ['zh', 'en']
     TODOISM_ITEMS_PER_PAGE = 10
+    # API中per_page参数的上限
+    TODOISM_MAX_PER_PAGE = 100
+    # /app页面每次渲染的条目数量, 滚动到底部时继续加载
+    TODOISM_APP_ITEMS_PER_PAGE = 50
+    # FTS5分词器, trigram支持中文子串搜索(关键词至少3个字符), 纯英文内容可以使用unicode61
+    # SQLite不支持该分词器(trigram需要3.34以上)时使用unicode61, 没有FTS5时使用LIKE搜索
+    TODOISM_SEARCH_TOKENIZER = 'trigram'
+    TODOISM_BATCH_LIMIT = 500
+    TODOISM_EXPORT_BATCH_SIZE = 500
+    TODOISM_IMPORT_CHUNK_SIZE = 1000
+    TODOISM_CLEAR_CHUNK_SIZE = 500
+    TODOISM_SYNC_LIMIT = 500
+    TODOISM_SYNC_WINDOW = 2
+    TODOISM_TOMBSTONE_DAYS = 30
+    TODOISM_TOKEN_CACHE_SIZE = 4096
+    TODOISM_TOKEN_CACHE_TIMEOUT = 300
+    TODOISM_USER_CACHE_SIZE = 1024
+    TODOISM_USER_CACHE_TIMEOUT = 30
+    TODOISM_FRAGMENT_CACHE_SIZE = 4096
+    TODOISM_FRAGMENT_CACHE_TIMEOUT = 3600
+    TODOISM_PRECOMPILE_TEMPLATES = True
+    # 请求耗时和SQL统计, 开启后通过/metrics导出
+    TODOISM_METRICS = os.getenv('TODOISM_METRICS', '0') == '1'
+    # 读取/metrics需要在Authorization中提供Bearer令牌, 或来自允许的IP; 都不设置时拒绝所有请求
+    TODOISM_METRICS_TOKEN = os.getenv('TODOISM_METRICS_TOKEN')
+    TODOISM_METRICS_ALLOWED_IPS = list(filter(None, os.getenv('TODOISM_METRICS_ALLOWED_IPS', '').split(',')))
+    TODOISM_N_PLUS_ONE_THRESHOLD = 5
+    # 共享缓存后端, 需实现get/set/delete, 例如cachelib.RedisCache
+    TODOISM_CACHE_BACKEND = None
+
+    # 日志文件, 为None时不写入文件
+    TODOISM_LOG_FILE = os.path.join(BASE_DIR, 'logs', 'data.log')
+    # 日志队列的长度, 队列满时丢弃日志; 同一位置的错误在这段时间(秒)内只发送一封邮件
+    TODOISM_LOG_QUEUE_SIZE = 1000
+    TODOISM_ERROR_MAIL_INTERVAL = 300
+    # 未设置MAIL_SERVER或TODOISM_ADMIN_EMAIL时不发送错误邮件
+    TODOISM_ADMIN_EMAIL = os.getenv('TODOISM_ADMIN_EMAIL')
+
+    MAIL_SERVER = os.getenv('MAIL_SERVER')
+    MAIL_PORT = int(os.getenv('MAIL_PORT', 25))
+    MAIL_USE_TLS = os.getenv('MAIL_USE_TLS', '0') == '1'
+    MAIL_USERNAME = os.getenv('MAIL_USERNAME')
+    MAIL_PASSWORD = os.getenv('MAIL_PASSWORD')
+    MAIL_DEFAULT_SENDER = os.getenv('MAIL_DEFAULT_SENDER', MAIL_USERNAME or 'todoism@localhost')
+    MAIL_TIMEOUT = 5
+
+    # 令牌有效期(秒)
+    TODOISM_ACCESS_TOKEN_EXPIRATION = int(os.getenv('TODOISM_ACCESS_TOKEN_EXPIRATION', 3600))
+    TODOISM_REFRESH_TOKEN_EXPIRATION = int(os.getenv('TODOISM_REFRESH_TOKEN_EXPIRATION', 30 * 24 * 3600))
+    # 同时计算密码哈希的线程数, 等待中的任务超过TODOISM_PASSWORD_QUEUE_SIZE时返回503
+    TODOISM_PASSWORD_WORKERS = int(os.getenv('TODOISM_PASSWORD_WORKERS', 2))
+    TODOISM_PASSWORD_QUEUE_SIZE = 32
+    TODOISM_PASSWORD_TIMEOUT = 10
+
+    # 事件流: 每个连接最多缓存的事件数(溢出时让客户端重新同步), 心跳间隔和连接时长(秒), 进程内的连接数上限
+    TODOISM_EVENT_QUEUE_SIZE = 100
+    TODOISM_EVENT_HEARTBEAT = 15
+    TODOISM_EVENT_STREAM_TIMEOUT = 300
+    TODOISM_EVENT_MAX_CONNECTIONS = int(os.getenv('TODOISM_EVENT_MAX_CONNECTIONS', 10000))
+    # 多进程部署时转发事件的本地套接字目录, 也可以在TODOISM_EVENT_TRANSPORT中提供其他转发方式
+    TODOISM_EVENT_SOCKET_DIR = os.getenv('TODOISM_EVENT_SOCKET_DIR')
+    TODOISM_EVENT_TRANSPORT = None
+
+    # 按Accept-Encoding压缩超过一定字节数的文本响应, 安装了brotli时优先使用br
+    TODOISM_COMPRESS = True
+    TODOISM_COMPRESS_MIN_SIZE = 500
+    TODOISM_GZIP_LEVEL = 6
+    TODOISM_BROTLI_QUALITY = 4
+    # flask assets build生成的静态文件清单, 不存在时使用原文件; 带哈希的文件缓存的秒数
+    TODOISM_ASSET_MANIFEST = os.path.join(BASE_DIR, 'todoism', 'static', 'dist', 'manifest.json')
+    TODOISM_ASSET_MAX_AGE = 365 * 24 * 3600
 
     SECRET_KEY = os.getenv('SECRET_KEY', 'secret-key')
     SERVER_NAME = 'todoism.site:8000'
 
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # 使用SQLite时每个新连接执行的PRAGMA
+    TODOISM_SQLITE_PRAGMAS = {}
+    # 只读副本的bind名称, 需要在SQLALCHEMY_BINDS中配置
+    TODOISM_READ_REPLICAS = []
+    # 写入后读取主库的秒数, 记录在进程内(或TODOISM_CACHE_BACKEND)和签名的cookie中
+    TODOISM_REPLICA_PIN_SECONDS = 5
+    # 切换完成状态时不读取条目, 用一条UPDATE完成, 并在时间窗口(秒)内合并并发的写操作为一次提交
+    TODOISM_WRITE_COALESCING = False
+    TODOISM_GROUP_COMMIT_WINDOW = 0.005
+    TODOISM_GROUP_COMMIT_SIZE = 64
 
     BABEL_DEFAULT_LOCALE = TODOISM_LOCALES[0]
 
 
 class Development(Base):
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'data-dev.db')
+    # 开发时修改的静态文件立即生效
+    TODOISM_ASSET_MANIFEST = None
 
 
 class Testing(Base):
     TESTING = True
     WTF_CSRF_ENABLED = False
     SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
+    # 并行运行测试时各进程不共享日志文件, 也不发送错误邮件
+    TODOISM_LOG_FILE = None
+    MAIL_SERVER = None
+    TODOISM_ASSET_MANIFEST = None
 
 
 class Production(Base):
     SERVER_NAME = 'todoism.com'
     SQLALCHEMY_DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///' + os.path.join(BASE_DIR, 'data.db'))
+    SQLALCHEMY_ENGINE_OPTIONS = engine_options(SQLALCHEMY_DATABASE_URI)
+    # 逗号分隔的只读副本地址
+    SQLALCHEMY_BINDS = {'replica_%d' % i: uri for i, uri in enumerate(filter(None, os.getenv(
+        'DATABASE_REPLICA_URIS', '').split(',')))}
+    TODOISM_READ_REPLICAS = sorted(SQLALCHEMY_BINDS)
+    TODOISM_SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 15000)),
+        'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+        'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', -64 * 1024)),
+        'temp_store': 'MEMORY'
+    }
 
 
 config = {
@@ -1,6 +1,8 @@
 $(document).ready(function () {
     var ENTER_KEY = 13;
     var ESC_KEY = 27;
+    // identifies this tab in the events pushed by the server, so it can skip its own changes
+    var client_id = Math.random().toString(36).slice(2);
 
     $(document).ajaxError(function (event, request) {
         var message = null;
@@ -28,6 +30,7 @@ $(document).ready(function () {
 
     $.ajaxSetup({
         beforeSend: function (xhr, settings) {
+            xhr.setRequestHeader('X-Client-Id', client_id);
             if (!/^(GET|HEAD|OPTIONS|TRACE)$/i.test(settings.type) && !this.crossDomain) {
                 xhr.setRequestHeader('X-CSRFToken', csrf_token);
             }
@@ -51,10 +54,83 @@ $(document).ready(function () {
             success: function (data) {
                 $('#main').hide().html(data).fadeIn(800);
                 activeM();
+                if (hash === 'app') {
+                    open_events();
+                } else {
+                    close_events();
+                }
             }
         })
     });
 
+    var event_source = null;
+
+    // receive the changes made in other tabs and devices instead of polling
+    function open_events() {
+        if (event_source !== null || !window.EventSource) {
+            return;
+        }
+        var reconnect = false;
+        var missed = false;
+        event_source = new EventSource(events_url);
+        event_source.addEventListener('change', function (e) {
+            var data = JSON.parse(e.data);
+            if (data.origin !== client_id) {
+                apply_changes(data);
+            }
+        });
+        event_source.addEventListener('resync', function (e) {
+            if (JSON.parse(e.data).origin !== client_id) {
+                $(window).trigger('hashchange');
+            }
+        });
+        // the server closes the stream from time to time, the browser reconnects without losing events
+        event_source.addEventListener('reconnect', function () {
+            reconnect = true;
+        });
+        event_source.onerror = function () {
+            missed = !reconnect;
+            reconnect = false;
+        };
+        event_source.onopen = function () {
+            if (missed) {
+                missed = false;
+                $(window).trigger('hashchange');
+            }
+        };
+    }
+
+    function close_events() {
+        if (event_source !== null) {
+            event_source.close();
+            event_source = null;
+        }
+    }
+
+    function apply_changes(data) {
+        var $items = $('.items');
+        $.each(data.deleted, function (i, id) {
+            $('.item[data-id="' + id + '"]').remove();
+        });
+        $.each(data.updated, function (i, item) {
+            var $item = $('.item[data-id="' + item.id + '"]');
+            $item.data('done', item.done).data('body', item.body);
+            $('#body-' + item.id).text(item.body).toggleClass('inactive-item', item.done)
+                .toggleClass('active-item', !item.done);
+            $item.find('.done-btn i').text(item.done ? 'check_box' : 'check_box_outline_blank');
+        });
+        // new items belong at the end of the list, wait until the last page is loaded
+        if (!$items.data('next')) {
+            $.each(data.created, function (i, item) {
+                if ($('.item[data-id="' + item.id + '"]').length === 0) {
+                    $items.append(item.html);
+                }
+            });
+        }
+        change_count(data.counts[0], data.counts[1]);
+        activeM();
+    }
+
     if (window.location.hash === '') {
         window.location.hash = "#intro";
     } else {
@@ -62,7 +138,7 @@ $(document).ready(function () {
     }
 
     function display_dashboard() {
-        var all_count = $('.item').length;
+        var all_count = parseInt($('#all-count').text()) || 0;
         if (all_count === 0) {
             $('#dashboard').hide();
         } else {
@@ -175,31 +251,63 @@ $(document).ready(function () {
         });
     });
 
-    $(document).on('click', '#active-item', function () {
-        var $input = $('#item-input');
-        var $items = $('.item');
+    var items_request = null;
 
-        $input.focus();
-        $items.show();
-        $items.filter(function () {
-            return $(this).data('done');
-        }).hide();
-    });
+    // load a page of items rendered by the server, replace the list when switching tabs
+    function load_items(url, replace) {
+        if (items_request !== null) {
+            // scrolling retries on the next scroll event
+            if (!replace) {
+                return;
+            }
+            // the pending page belongs to the previous tab or search, replace it
+            items_request.abort();
+        }
+        var request = items_request = $.ajax({
+            type: 'GET',
+            url: url,
+            success: function (data) {
+                var $items = $('.items');
+                if (replace) {
+                    $items.html(data.html);
+                } else {
+                    // skip items that are already on the list, e.g. added or pushed before this page was loaded
+                    $items.append($($.parseHTML(data.html)).filter('.item').filter(function () {
+                        return $('.item[data-id="' + $(this).data('id') + '"]').length === 0;
+                    }));
+                }
+                $items.data('next', data.next || '');
+            },
+            complete: function () {
+                if (items_request === request) {
+                    items_request = null;
+                }
+            }
+        });
+    }
 
-    $(document).on('click', '#completed-item', function () {
-        var $input = $('#item-input');
-        var $items = $('.item');
+    $(document).on('click', '#all-item, #active-item, #completed-item', function () {
+        $('#item-input').focus();
+        load_items($(this).data('href'), true);
+    });
 
-        $input.focus();
-        $items.show();
-        $items.filter(function () {
-            return !$(this).data('done');
-        }).hide();
+    $(document).on('keyup', '#search-input', function (e) {
+        var $search = $(this);
+        var value = $search.val().trim();
+        if (e.which === ENTER_KEY) {
+            load_items(value ? $search.data('href') + '?q=' + encodeURIComponent(value) : $search.data('all-href'), true);
+        } else if (e.keyCode === ESC_KEY) {
+            $search.val('');
+            load_items($search.data('all-href'), true);
+        }
     });
 
-    $(document).on('click', '#all-item', function () {
-        $('#item-input').focus();
-        $('.item').show();
+    // infinite scroll
+    $(window).on('scroll', function () {
+        var next = $('.items').data('next');
+        if (next && $(window).scrollTop() + $(window).height() > $(document).height() - 200) {
+            load_items(next, false);
+        }
     });
 
     $(document).on('click', '#clear-btn', function () {
@@ -215,7 +323,7 @@ $(document).ready(function () {
                     return $(this).data('done');
                 }).remove();
                 M.toast({html: data.message, classes: 'rounded'});
-                refresh_count();
+                change_count(-data.count, 0);
             }
         });
     });
@@ -241,21 +349,16 @@ $(document).ready(function () {
         $input.focus();
     }
 
-    function refresh_count() {
-        var $items = $('.item');
-
-        display_dashboard();
-        var all_count = $items.length;
-        var active_count = $items.filter(function () {
-            return $(this).data('done') === false;
-        }).length;
-        var completed_count = $items.filter(function () {
-            return $(this).data('done') === true;
-        }).length;
+    // only one page of items is rendered, so adjust the counts from the server instead of counting items
+    function change_count(all_delta, active_delta) {
+        var all_count = (parseInt($('#all-count').text()) || 0) + all_delta;
+        var active_count = (parseInt($('#active-count').text()) || 0) + active_delta;
+        var completed_count = all_count - active_count;
         $('#all-count').html(all_count);
         $('#active-count').html(active_count);
         $('#active-count-nav').html(active_count);
         $('#completed-count').html(completed_count);
+        display_dashboard();
     }
 
     function new_item(e) {
@@ -272,9 +375,13 @@ $(document).ready(function () {
             contentType: 'application/json;charset=UTF-8',
             success: function (data) {
                 M.toast({html: data.message, classes: 'rounded'});
-                $('.items').append(data.html);
+                var $items = $('.items');
+                // new items belong at the end of the list, the last page will include it otherwise
+                if (!$items.data('next')) {
+                    $items.append(data.html);
+                }
                 activeM();
-                refresh_count();
+                change_count(1, 1);
             }
         });
     }
@@ -332,7 +439,7 @@ $(document).ready(function () {
                     $this.find('i').text('check_box_outline_blank');
                     $item.data('done', false);
                     M.toast({html: data.message});
-                    refresh_count();
+                    change_count(0, 1);
                 }
             })
         } else {
@@ -345,7 +452,7 @@ $(document).ready(function () {
                     $this.find('i').text('check_box');
                     $item.data('done', true);
                     M.toast({html: data.message});
-                    refresh_count();
+                    change_count(0, -1);
                 }
             })
 
@@ -407,7 +514,7 @@ $(document).ready(function () {
             success: function (data) {
                 $item.remove();
                 activeM();
-                refresh_count();
+                change_count(-1, $item.data('done') ? 0 : -1);
                 M.toast({html: data.message});
             }
         });